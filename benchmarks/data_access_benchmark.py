@@ -0,0 +1,191 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import subprocess
+import contextlib
+
+# Latency of the data access path against page depth, page size and duplicate rate, with synthetic
+# shards served by the in-process S3 and MongoDB stand-ins of benchmarks/stand_ins.py. Results are
+# written as JSON, pass the file of an earlier commit with --compare to print the ratios.
+# Run from the root directory: python -m benchmarks.data_access_benchmark --output results.json
+MEDIA = "test"
+SEARCH_KEY = "bitcoin"
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=200)
+    parser.add_argument("--rows-per-shard", type=int, default=1000)
+    parser.add_argument("--duplicate-rates", type=float, nargs="+", default=[0.0, 0.05, 0.2], help="fraction of rows whose url is in an earlier row")
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[20, 100, 1000])
+    parser.add_argument("--depths", type=int, nargs="+", default=[1, 10, 100, 1000], help="page numbers, pages beyond the data are skipped")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--s3-latency-ms", type=float, default=20.0)
+    parser.add_argument("--s3-bandwidth-mbps", type=float, default=None, help="MB per second of a GET, no limit by default")
+    parser.add_argument("--mongo-latency-ms", type=float, default=2.0)
+    parser.add_argument("--shard-cache", action="store_true", help="keep the shard cache enabled, shards are then read from S3 only once")
+    parser.add_argument("--output", default=None, help="JSON file of the results, printed when not given")
+    parser.add_argument("--compare", default=None, help="JSON results of an earlier run to compare with")
+    return parser.parse_args()
+
+# The modules read their settings and connect lazily on import, placeholders are enough
+def configure_environment(args):
+    for name in ["database_string", "mongodb_string", "wasabi_access_key_id", "wasabi_secret_access_key", "wasabi_aws-region", "jwt_secret_key"]:
+        os.environ.setdefault(name, "sqlite://" if name == "database_string" else "mongodb://localhost" if name == "mongodb_string" else "benchmark")
+    os.environ["shard_cache_enabled"] = "true" if args.shard_cache else "false"
+    os.environ["shard_cache_disk_mb"] = "0"
+    os.environ["response_cache_enabled"] = "false"
+    os.environ["prefetch_enabled"] = "false"
+
+# Shards of rows_per_shard rows and their metadata documents, newest first like created_at sorting
+def make_dataset(shard_count, rows_per_shard, duplicate_rate, seed=0):
+    import pandas as pd
+    random.seed(seed)
+    urls = []
+    shards = []
+    documents = []
+    start = datetime.datetime(2023, 11, 1)
+    for position in range(shard_count):
+        rows = []
+        for _ in range(rows_per_shard):
+            if len(urls) > 0 and random.random() < duplicate_rate:
+                url = random.choice(urls)
+            else:
+                url = "https://www.reddit.com/r/Bitcoin/comments/%x/" % random.getrandbits(48)
+                urls.append(url)
+            rows.append(url)
+        created_at = start + datetime.timedelta(minutes=position)
+        df = pd.DataFrame({
+            "id": ["t3_%x" % random.getrandbits(32) for _ in rows],
+            "url": rows,
+            "text": [" ".join(random.choice(["bitcoin", "etf", "price", "market", "moon", "hodl"]) for _ in range(30)) for _ in rows],
+            "likes": [random.randint(0, 5000) for _ in rows],
+            "dataType": [random.choice(["post", "comment"]) for _ in rows],
+            "timestamp": [created_at.isoformat() + "Z"] * len(rows),
+        })
+        file_name = "%s_%06d.csv" % (MEDIA, position)
+        shards.append((file_name, df.to_csv(index=False).encode("utf-8")))
+        documents.append({"_id": position, "file_name": file_name, "source_name": MEDIA, "search_keys": [SEARCH_KEY], "row_count": rows_per_shard, "created_at": created_at})
+    return shards, documents
+
+def percentiles(samples):
+    samples = sorted(samples)
+
+    def rank(fraction):
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {"p50_ms": rank(0.5) * 1000, "p90_ms": rank(0.9) * 1000, "p99_ms": rank(0.99) * 1000, "mean_ms": sum(samples) / len(samples) * 1000}
+
+async def measure(method, repeat, before=None):
+    samples = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        await method()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+async def run_case(args, page_size, page_number, modules):
+    data_access, router, page_map = modules
+    lower_bound = (page_number - 1) * page_size + 1
+    upper_bound = lower_bound + page_size - 1
+    bucket_name = MEDIA + 'scrapingbucket'
+
+    async def files_name():
+        return await data_access.get_files_name(None, SEARCH_KEY, "asc", lower_bound, upper_bound, MEDIA, router.COLLECTION_NAME)
+
+    last_record, file_names, shards = await files_name()
+
+    async def csv_record():
+        return await data_access.get_csv_record(last_record, lower_bound, upper_bound, bucket_name, file_names, MEDIA + "/", shards)
+
+    async def get_data():
+        return await router.get_data(SEARCH_KEY, None, page_size, page_number, "asc", MEDIA)
+
+    return {
+        "page_size": page_size,
+        "page_number": page_number,
+        "shards_read": len(file_names),
+        "get_files_name_cold": await measure(files_name, args.repeat, page_map.invalidate),
+        "get_files_name": await measure(files_name, args.repeat),
+        "get_csv_record": await measure(csv_record, args.repeat),
+        "get_data": await measure(get_data, args.repeat),
+    }
+
+async def run(args):
+    from benchmarks.stand_ins import S3StandIn, MongoStandIn
+    from utils import data_access, page_map
+    from routers.data_access import data_access as router
+
+    cases = []
+    for duplicate_rate in args.duplicate_rates:
+        shards, documents = make_dataset(args.shards, args.rows_per_shard, duplicate_rate)
+        s3 = S3StandIn(args.s3_latency_ms / 1000, args.s3_bandwidth_mbps * 1024 * 1024 if args.s3_bandwidth_mbps else None)
+        mongo = MongoStandIn(args.mongo_latency_ms / 1000)
+        for file_name, data in shards:
+            s3.put_object(Bucket=MEDIA + 'scrapingbucket', Key=MEDIA + "/" + file_name, Body=data)
+        mongo['scraping'][router.COLLECTION_NAME].insert_many(documents)
+        data_access.s3_client = s3
+        data_access.MongoClient = mongo
+        page_map.invalidate()
+        total_rows = args.shards * args.rows_per_shard
+        for page_size in args.page_sizes:
+            for page_number in args.depths:
+                if (page_number - 1) * page_size >= total_rows:
+                    continue
+                # get_start_position prints the search key of every page, only the results are printed here
+                with contextlib.redirect_stdout(io.StringIO()):
+                    case = await run_case(args, page_size, page_number, (data_access, router, page_map))
+                case["duplicate_rate"] = duplicate_rate
+                cases.append(case)
+                print("duplicates {:.2f} page size {:>5} page {:>5}: get_data p50 {:.1f} ms".format(duplicate_rate, page_size, page_number, case["get_data"]["p50_ms"]), file=sys.stderr)
+    return cases
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def case_key(case):
+    return (case["duplicate_rate"], case["page_size"], case["page_number"])
+
+# Ratio of the p50 of every measure to the p50 of the same case in the earlier results
+def compare(results, previous):
+    previous_cases = {case_key(case): case for case in previous["cases"]}
+    measures = ["get_files_name_cold", "get_files_name", "get_csv_record", "get_data"]
+    print("{:>10} {:>9} {:>6} ".format("duplicates", "page size", "page") + " ".join("{:>20}".format(name) for name in measures))
+    for case in results["cases"]:
+        earlier = previous_cases.get(case_key(case))
+        if earlier is None:
+            continue
+        ratios = [case[name]["p50_ms"] / earlier[name]["p50_ms"] if earlier[name]["p50_ms"] > 0 else float("nan") for name in measures]
+        print("{:>10.2f} {:>9} {:>6} ".format(*case_key(case)) + " ".join("{:>19.2f}x".format(ratio) for ratio in ratios))
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    results = {
+        "commit": git_commit(),
+        "created_at": datetime.datetime.utcnow().isoformat() + "Z",
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "cases": asyncio.run(run(args)),
+    }
+    body = json.dumps(results, indent=2)
+    if args.output is None:
+        print(body)
+    else:
+        with open(args.output, "w") as file:
+            file.write(body)
+    if args.compare is not None:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import argparse
+import random
+import time
+
+from utils.page_map import PageMap
+
+# Page resolution latency against page depth: linear walk over the metadata (previous
+# get_files_name behaviour) versus the prefix-sum page map.
+# Run from the root directory: python -m benchmarks.page_map_benchmark
+
+def linear_walk(documents, lower_bound, upper_bound):
+    first_row_number_of_file = 0
+    last_row_number_of_file = 0
+    file_names = []
+    for file_name, row_count in documents:
+        if row_count == 0:
+            continue
+        first_row_number_of_file = last_row_number_of_file + 1
+        last_row_number_of_file = first_row_number_of_file + row_count - 1
+        if first_row_number_of_file > upper_bound:
+            last_row_number_of_file = first_row_number_of_file - 1
+            break
+        if last_row_number_of_file < lower_bound:
+            continue
+        file_names.append(file_name)
+    return last_row_number_of_file, file_names
+
+def measure(method, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = method()
+    return (time.perf_counter() - start) / repeat * 1000, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, default=20000)
+    parser.add_argument("--rows-per-shard", type=int, default=500)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(0)
+    documents = [("file_%d.csv" % i, random.randint(0, args.rows_per_shard * 2)) for i in range(args.shards)]
+
+    start = time.perf_counter()
+    page_map = PageMap(documents)
+    print("build: {:.2f} ms for {} shards, {} rows".format((time.perf_counter() - start) * 1000, len(page_map), page_map.total()))
+    print("{:>10} {:>14} {:>14}".format("page", "linear (ms)", "page map (ms)"))
+
+    max_page = page_map.total() // args.page_size
+    page_number = 1
+    while page_number <= max_page:
+        lower_bound = (page_number - 1) * args.page_size + 1
+        upper_bound = lower_bound + args.page_size - 1
+        linear_ms, expected = measure(lambda: linear_walk(documents, lower_bound, upper_bound), args.repeat)
+        map_ms, result = measure(lambda: page_map.resolve(lower_bound, upper_bound), args.repeat)
+        assert result == expected, (page_number, result, expected)
+        print("{:>10} {:>14.4f} {:>14.4f}".format(page_number, linear_ms, map_ms))
+        page_number *= 10
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import os
+import json
+import time
+import random
+import argparse
+
+# The router modules connect lazily, placeholder settings are enough to import them
+for name in ["database_string", "mongodb_string", "wasabi_access_key_id", "wasabi_secret_access_key", "wasabi_aws-region", "jwt_secret_key"]:
+    os.environ.setdefault(name, "sqlite://" if name == "database_string" else "mongodb://localhost" if name == "mongodb_string" else "benchmark")
+
+import pandas as pd
+
+from routers.data_access.reddit import RedditModel, RedditData
+from utils import serialization
+
+# Serialization of a data page: previous to_json -> json.loads -> pydantic response_model -> JSON
+# chain versus encoding the DataFrame once.
+# Run from the root directory: python -m benchmarks.serialization_benchmark
+
+def make_page(rows):
+    random.seed(rows)
+    return pd.DataFrame({
+        "index": range(1, rows + 1),
+        "id": ["t3_%x" % random.getrandbits(32) for _ in range(rows)],
+        "url": ["https://www.reddit.com/r/Bitcoin/comments/%x/" % random.getrandbits(40) for _ in range(rows)],
+        "text": [" ".join(random.choice(["bitcoin", "etf", "price", "market", "moon", "hodl"]) for _ in range(60)) for _ in range(rows)],
+        "likes": [float(random.randint(0, 5000)) for _ in range(rows)],
+        "dataType": [random.choice(["post", "comment"]) for _ in range(rows)],
+        "timestamp": ["2023-11-21T00:22:55.000Z"] * rows,
+        "csv_file": ["reddit_0001.csv"] * rows,
+    })
+
+def previous_path(df):
+    data = json.loads(df.to_json(orient="records"))
+    model = RedditModel(total_duration=0.1, reading_mongodb_duration=0.1, reading_s3_duration=0.1, data=data)
+    return model.model_dump_json(exclude_unset=True).encode("utf-8")
+
+def fast_path(df):
+    return serialization.encode_response({"total_duration": 0.1, "reading_mongodb_duration": 0.1, "reading_s3_duration": 0.1}, df, RedditData)
+
+def measure(method, df, repeat):
+    method(df)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = method(df)
+    return (time.perf_counter() - start) / repeat * 1000, len(body)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+    print("{:>8} {:>16} {:>16} {:>10}".format("rows", "previous (ms)", "fast path (ms)", "speedup"))
+    for rows in [100, 1000, 10000]:
+        df = make_page(rows)
+        previous_ms, _ = measure(previous_path, df, args.repeat)
+        fast_ms, _ = measure(fast_path, df, args.repeat)
+        assert json.loads(previous_path(df))["data"] == json.loads(fast_path(df))["data"]
+        print("{:>8} {:>16.2f} {:>16.2f} {:>9.1f}x".format(rows, previous_ms, fast_ms, previous_ms / fast_ms))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.multithread import parallel_async
+
+# Concurrent-request throughput of get_csv_record style shard fetching, with the previous
+# per-call ThreadPoolExecutor iterated inside the coroutine versus the shared executor.
+# S3 is simulated by a blocking sleep, parsing by a short busy loop.
+# Run from the root directory: python -m benchmarks.shard_fetch_load_test
+
+def download_object(args):
+    latency, parse_ms = args
+    time.sleep(latency)
+    end = time.perf_counter() + parse_ms / 1000
+    while time.perf_counter() < end:
+        pass
+    return latency
+
+def parallel_multithreading(method, array):
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = executor.map(method, array)
+        for result in results:
+            yield result
+
+async def blocking_request(shards):
+    return [result for result in parallel_multithreading(download_object, shards)]
+
+async def async_request(shards):
+    return await parallel_async(download_object, shards)
+
+# Measures how late a 10 ms timer fires, i.e. how long the loop was blocked
+async def heartbeat(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append(time.perf_counter() - start - 0.01)
+
+async def run(request, clients, requests_per_client, shards):
+    lags = []
+    stop = asyncio.Event()
+    monitor = asyncio.create_task(heartbeat(lags, stop))
+
+    async def client():
+        for _ in range(requests_per_client):
+            await request(shards)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(clients)])
+    duration = time.perf_counter() - start
+    stop.set()
+    await monitor
+    lags.sort()
+    return {
+        "requests_per_second": clients * requests_per_client / duration,
+        "loop_lag_p50_ms": lags[len(lags) // 2] * 1000 if lags else 0,
+        "loop_lag_max_ms": lags[-1] * 1000 if lags else 0,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=5)
+    parser.add_argument("--shards", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--parse-ms", type=float, default=2)
+    args = parser.parse_args()
+    shards = [(args.latency, args.parse_ms)] * args.shards
+
+    for name, request in [("per-call thread pool", blocking_request), ("shared executor", async_request)]:
+        result = asyncio.run(run(request, args.clients, args.requests, shards))
+        print("{:<22} {:>8.1f} req/s   loop lag p50 {:>7.1f} ms   max {:>7.1f} ms".format(
+            name, result["requests_per_second"], result["loop_lag_p50_ms"], result["loop_lag_max_ms"]))
+
+if __name__ == "__main__":
+    main()
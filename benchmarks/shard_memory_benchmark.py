@@ -0,0 +1,71 @@
+import io
+import random
+import argparse
+import tracemalloc
+
+import pandas as pd
+
+from utils import schemas
+from utils.shard_reader import read_shard
+
+# Peak memory of parsing the shards of a page: previous inferred read_csv, csv_file string column
+# and pd.concat of the growing frame per shard, versus the schema types, categorical csv_file and
+# one concat. Measured with tracemalloc, which sees numpy and Python allocations but not the
+# buffers of the pyarrow parser (csv_engine=pyarrow).
+# Run from the root directory: python -m benchmarks.shard_memory_benchmark
+
+def make_shard(rows, seed):
+    random.seed(seed)
+    df = pd.DataFrame({
+        "id": ["t3_%x" % random.getrandbits(32) for _ in range(rows)],
+        "url": ["https://www.reddit.com/r/Bitcoin/comments/%x/" % random.getrandbits(40) for _ in range(rows)],
+        "text": [" ".join(random.choice(["bitcoin", "etf", "price", "market", "moon", "hodl"]) for _ in range(60)) for _ in range(rows)],
+        "likes": [random.randint(0, 5000) for _ in range(rows)],
+        "dataType": [random.choice(["post", "comment"]) for _ in range(rows)],
+        "timestamp": ["2023-11-21T00:22:55.000Z"] * rows,
+    })
+    return df.to_csv(index=False).encode("utf-8")
+
+def previous_path(shards):
+    df = pd.DataFrame()
+    page_df = pd.DataFrame()
+    for key, data in shards:
+        result = pd.read_csv(io.BytesIO(data))
+        result['csv_file'] = key
+        df = pd.concat([df, result], ignore_index=True)
+        page_df = pd.concat([page_df, result], ignore_index=True)
+    duplicates_length = len(df[df.duplicated(subset=["url"], keep='first')].index)
+    return page_df, duplicates_length
+
+def current_path(shards):
+    results = [schemas.tag_file(read_shard(data, "csv", None, "reddit"), key) for key, data in shards]
+    page_df = schemas.concat_frames(results)
+    duplicates_length = int(pd.concat([result["url"] for result in results], ignore_index=True).duplicated(keep='first').sum())
+    return page_df, duplicates_length
+
+# Peak bytes allocated while method runs and bytes of the frame it returns
+def measure(method, shards):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    page_df, _ = method(shards)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return peak, int(page_df.memory_usage(deep=True).sum())
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000, help="rows per shard")
+    args = parser.parse_args()
+    mb = 1024 * 1024
+    print("{:>7} {:>10} {:>20} {:>20} {:>16} {:>16}".format("shards", "raw (MB)", "previous peak (MB)", "current peak (MB)", "previous frame", "current frame"))
+    for shard_count in [1, 4, 16]:
+        shards = [("reddit_%04d.csv" % position, make_shard(args.rows, position)) for position in range(shard_count)]
+        raw = sum(len(data) for _, data in shards)
+        previous_peak, previous_frame = measure(previous_path, shards)
+        current_peak, current_frame = measure(current_path, shards)
+        assert len(previous_path(shards)[0].index) == len(current_path(shards)[0].index)
+        print("{:>7} {:>10.1f} {:>20.1f} {:>20.1f} {:>16.1f} {:>16.1f}".format(shard_count, raw / mb, previous_peak / mb, current_peak / mb, previous_frame / mb, current_frame / mb))
+
+if __name__ == "__main__":
+    main()
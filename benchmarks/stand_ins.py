@@ -0,0 +1,165 @@
+import io
+import time
+import asyncio
+import hashlib
+
+# In-process stand-ins for the Wasabi bucket and the MongoDB metadata collection, with the subset
+# of the boto3 and motor APIs the data access path uses. Every call can wait a fixed latency to
+# mimic the network round trip.
+
+class StandInError(Exception):
+    def __init__(self, code: str, status_code: int):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status_code}}
+
+class S3StandIn:
+    def __init__(self, latency: float = 0.0, bandwidth: float = None):
+        self.latency = latency
+        # Bytes per second of a GET, None for no limit
+        self.bandwidth = bandwidth
+        self.objects = {}
+        self.stats = {"get_object": 0, "put_object": 0, "bytes_fetched": 0}
+
+    def wait(self, size: int = 0):
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.stats["put_object"] += 1
+        data = Body if isinstance(Body, bytes) else Body.read()
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        self.objects[(Bucket, Key)] = (data, etag)
+        self.wait()
+        return {"ETag": etag}
+
+    def get_object(self, Bucket, Key, Range=None, IfNoneMatch=None, **kwargs):
+        self.stats["get_object"] += 1
+        entry = self.objects.get((Bucket, Key))
+        if entry is None:
+            self.wait()
+            raise StandInError("NoSuchKey", 404)
+        data, etag = entry
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            self.wait()
+            raise StandInError("304", 304)
+        if Range is not None:
+            start, end = Range[len("bytes="):].split("-")
+            data = data[int(start):int(end) + 1]
+        self.stats["bytes_fetched"] += len(data)
+        self.wait(len(data))
+        return {"Body": io.BytesIO(data), "ETag": etag, "ContentLength": len(data)}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        entry = self.objects.get((Bucket, Key))
+        self.wait()
+        if entry is None:
+            raise StandInError("404", 404)
+        return {"ETag": entry[1], "ContentLength": len(entry[0])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+        self.wait()
+        return {}
+
+# Subset of the MongoDB query language: equality, $exists, $gte, $lte, $gt, $lt, $in, $and, $or
+def matches(document, query):
+    for name, condition in query.items():
+        if name == "$and":
+            if not all(matches(document, part) for part in condition):
+                return False
+        elif name == "$or":
+            if not any(matches(document, part) for part in condition):
+                return False
+        elif isinstance(condition, dict) and any(key.startswith("$") for key in condition):
+            value = document.get(name)
+            for operator, operand in condition.items():
+                if operator == "$exists":
+                    if (name in document) != bool(operand):
+                        return False
+                elif value is None:
+                    return False
+                elif operator == "$gte" and not value >= operand:
+                    return False
+                elif operator == "$lte" and not value <= operand:
+                    return False
+                elif operator == "$gt" and not value > operand:
+                    return False
+                elif operator == "$lt" and not value < operand:
+                    return False
+                elif operator == "$in" and value not in operand:
+                    return False
+        elif document.get(name) != condition:
+            return False
+    return True
+
+def project(document, projection):
+    if not projection:
+        return dict(document)
+    included = {name for name, include in projection.items() if include}
+    return {name: value for name, value in document.items() if name in included or name == "_id"}
+
+class CursorStandIn:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_keys = []
+
+    def collation(self, collation):
+        return self
+
+    def sort(self, key, direction=1):
+        self.sort_keys.append((key, direction))
+        return self
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        await self.collection.wait()
+        documents = [document for document in self.collection.documents if matches(document, self.query)]
+        for key, direction in reversed(self.sort_keys):
+            documents.sort(key=lambda document: (document.get(key) is None, document.get(key)), reverse=direction == -1)
+        for document in documents:
+            yield project(document, self.projection)
+
+class CollectionStandIn:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.documents = []
+        self.stats = {"find": 0}
+
+    async def wait(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+    def insert_many(self, documents):
+        self.documents.extend(documents)
+
+    def find(self, query=None, projection=None):
+        self.stats["find"] += 1
+        return CursorStandIn(self, query or {}, projection)
+
+    async def find_one(self, query=None, projection=None):
+        await self.wait()
+        for document in self.documents:
+            if matches(document, query or {}):
+                return project(document, projection)
+        return None
+
+class MongoStandIn:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.databases = {}
+
+    def __getitem__(self, name):
+        return self.databases.setdefault(name, DatabaseStandIn(self.latency))
+
+class DatabaseStandIn:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, CollectionStandIn(self.latency))
@@ -1,8 +1,12 @@
+import asyncio
 from typing import Annotated
 from fastapi import FastAPI, Depends
 import server.models as models
-from server.database import engine
-from routers import auth, avatar, netstatus, data_access, overview, api_key
+from server.database import engine, MongoClient
+from routers import auth, avatar, netstatus, data_access, overview, api_key, cache, metrics, profiles
+from utils import page_map, response_cache, charge_leases, export
+from utils.request_timing import TimingMiddleware
+from utils.profiling import ProfilingMiddleware
 import routers as router
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -17,7 +21,12 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", "X-Shard-Count", "X-Bytes-Fetched", "X-Dedup-Iterations", "X-Cache", "X-Profile-Id"],
 )
+# Stage durations of every request in the Server-Timing header, see utils/request_timing.py
+app.add_middleware(TimingMiddleware)
+# Profiles of the requests of admin users sent with an X-Profile header, see utils/profiling.py
+app.add_middleware(ProfilingMiddleware)
 
 #only run when db doesn't exist
 models.Base.metadata.create_all(bind=engine)
@@ -30,4 +39,30 @@ app.include_router(overview.router)
 app.include_router(api_key.router)
 app.include_router(data_access.redditRouter)
 app.include_router(data_access.twitterRouter)
-app.include_router(data_access.testRouter)
\ No newline at end of file
+app.include_router(data_access.testRouter)
+app.include_router(cache.router)
+app.include_router(metrics.router)
+app.include_router(profiles.router)
+
+@app.on_event("startup")
+async def watch_metadata():
+    # Metadata changed by other servers and jobs invalidates the cached pages and page maps
+    if response_cache.WATCH_ENABLED:
+        app.state.metadata_watcher = asyncio.create_task(response_cache.watch_catalogue(MongoClient['scraping']['scraping'], page_map.invalidate))
+
+@app.on_event("startup")
+async def watch_export_jobs():
+    # Exports left queued or running by a stopped server are failed and refunded
+    app.state.export_watcher = asyncio.create_task(export.watch_jobs())
+
+@app.on_event("startup")
+async def flush_key_usage():
+    # Uses of the API keys leased by this worker are written every api_key_flush_seconds
+    if charge_leases.ENABLED:
+        app.state.key_usage_flusher = asyncio.create_task(charge_leases.flush_periodically())
+
+@app.on_event("shutdown")
+async def write_key_usage():
+    if charge_leases.ENABLED:
+        app.state.key_usage_flusher.cancel()
+        await charge_leases.flush()
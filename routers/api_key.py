@@ -9,7 +9,7 @@ from sqlalchemy.orm import Session
 
 from utils import api_key_utils
 
-api_key_dependency = Annotated[str, Depends(api_key_utils.get_api_key_header)]
+api_key_dependency = Annotated[str, Depends(api_key_utils.consume_api_key_header)]
 
 router = APIRouter(
     prefix='/api_key',
@@ -26,10 +26,8 @@ def get_db():
 db_dependency = Annotated[Session, Depends(get_db)]
 
 @router.post("/verify_key", status_code=status.HTTP_200_OK)
-async def get_latest_twitter(db: db_dependency, api_key: api_key_dependency):
+async def get_latest_twitter(api_key: api_key_dependency):
     try:
-        
-        await api_key_utils.consume_key(db, api_key)
         return {
                 "response": "ok"
                 }
@@ -0,0 +1,26 @@
+from fastapi import APIRouter, Depends, HTTPException
+from starlette import status
+from utils.auth import get_current_user
+from utils import data_access, response_cache, shard_cache, prefetch
+from routers.data_access.data_access import page_builds
+from typing import Annotated
+
+router = APIRouter(
+    prefix='/cache',
+    tags=['cache']
+)
+
+user_dependency = Annotated[dict, Depends(get_current_user)]
+
+
+@router.get("/stats", status_code=status.HTTP_200_OK)
+async def get_cache_stats(user: user_dependency):
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Authentication Failed')
+    return {
+        "response_cache": None if response_cache.cache is None else response_cache.cache.get_stats(),
+        "shard_cache": None if shard_cache.cache is None else shard_cache.cache.get_stats(),
+        "coalesced_pages": page_builds.get_stats(),
+        "coalesced_shard_downloads": data_access.shard_downloads.get_stats(),
+        "prefetch": prefetch.get_stats() if prefetch.ENABLED else None,
+    }
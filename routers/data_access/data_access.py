@@ -1,106 +1,240 @@
 import time
-import json
-import pandas as pd
-from fastapi import BackgroundTasks
+from typing import Optional
+from pydantic import BaseModel, Field, ConfigDict
+from fastapi import Response
 
 
-from utils import data_access, log_utils
+from utils import data_access, serialization, response_cache, prefetch, shard_stats, export, schemas, metrics, request_timing
+from utils.shard_reader import project_columns
+from utils.single_flight import SingleFlight
+from utils.multithread import run_in_thread
 
 # dev/scraping
 COLLECTION_NAME="scraping"
 
-async def get_data(searchKey, sortKey, pageSize, pageNumber, sortDirection, media: str, background_tasks: BackgroundTasks):
-    print(searchKey)
+# Column names of the comma separated fields query parameter, None for all columns
+def parse_fields(fields: str, model):
+    if fields is None:
+        return None
+    names = [name.strip() for name in fields.split(",") if name.strip() != ""]
+    unknown = [name for name in names if name not in model.model_fields or name == "index"]
+    if len(names) == 0 or len(unknown) > 0:
+        raise Exception("Invalid input of fields, please choose from " + ", ".join(name for name in model.model_fields if name != "index") + ".")
+    return names
+
+# Response format of the format query parameter or the Accept header, "json" or "ndjson"
+def get_response_format(format: str, accept: str):
+    if format is None:
+        return "ndjson" if "application/x-ndjson" in (accept or "") else "json"
+    if format not in ("json", "ndjson"):
+        raise Exception("Invalid input of format, please choose json or ndjson.")
+    return format
+
+# Row filters of the query parameters, None when no filter is given. Timestamps are kept as ISO
+# strings so that filters can be part of cache keys and cursors.
+def parse_filters(text: str = None, from_: str = None, to: str = None, min_likes: int = None):
+    filters = {}
+    if text is not None:
+        filters["text"] = text
+    for name, value in (("from", from_), ("to", to)):
+        if value is not None:
+            try:
+                filters[name] = shard_stats.to_timestamp(value).isoformat()
+            except Exception:
+                raise Exception("Invalid input of " + name + ", please use an ISO 8601 date or time such as 2023-11-21T00:00:00Z.")
+    if min_likes is not None:
+        filters["min_likes"] = min_likes
+    return filters or None
+
+# First row number of the page and the index of its first row
+async def get_start_position(searchKey, sortKey, pageSize, pageNumber, sortDirection, media: str, cursor: str = None, filters: dict = None):
     if searchKey == "" or sortKey == "":
         raise Exception("Invalid input of searchKey or sortKey, please do not enter nothing in query parameter or use URL encoded characters for special characters.")
-    initial_lower_bound =  (pageNumber - 1) * pageSize + 1
-    lower_bound = initial_lower_bound
-    upper_bound = lower_bound + pageSize - 1
-    loop = True
-    duplicates_df = pd.DataFrame()
-    df_sum  = pd.DataFrame()
+    # Resume exactly where the previous page stopped, otherwise count rows from the first file
+    if cursor is not None:
+        return await data_access.get_cursor_position(cursor, sortKey, searchKey, sortDirection, media, COLLECTION_NAME, filters)
+    elif pageNumber is not None:
+        initial_lower_bound =  (pageNumber - 1) * pageSize + 1
+        return initial_lower_bound, initial_lower_bound
+    else:
+        raise Exception("Invalid input, please provide either pageNumber or cursor.")
+
+# Rows of a page read window after window, shared by the JSON and NDJSON responses so that both
+# return the same rows and next cursor. Rows whose url is earlier in the window or in an earlier
+# window are dropped, and the next window reads as many rows as were dropped, until the page is
+# full or there are no rows left. upper_bound is the last row number read once rows() is done.
+class PageReader:
+    def __init__(self, searchKey, sortKey, pageSize, sortDirection, media: str, lower_bound: int, columns: list = None, filters: dict = None):
+        self.searchKey = searchKey
+        self.sortKey = sortKey
+        self.pageSize = pageSize
+        self.sortDirection = sortDirection
+        self.media = media
+        self.lower_bound = lower_bound
+        self.upper_bound = lower_bound + pageSize - 1
+        self.columns = columns
+        self.filters = filters
+        self.iterations = 0
+        # Time spent in MongoDB (get_files_name) and in S3 (get_csv_record) over all windows
+        self.reading_mongodb_duration = 0.0
+        self.reading_s3_duration = 0.0
+
+    # Rows of one window: the whole window at once, or shard by shard when by_shard
+    async def window_frames(self, last_record, lower_bound, file_names, shards, by_shard):
+        bucket_name = self.media + 'scrapingbucket'
+        prefix = self.media + "/"
+        if by_shard:
+            async for df in data_access.iterate_csv_records(last_record, lower_bound, self.upper_bound, bucket_name, file_names, prefix, shards, self.columns):
+                yield df
+            return
+        start_get_csv = time.time()
+        df = await data_access.get_csv_record(last_record, lower_bound, self.upper_bound, bucket_name, file_names, prefix, shards, self.columns)
+        self.reading_s3_duration += time.time() - start_get_csv
+        yield df
+
+    async def rows(self, by_shard=False):
+        lower_bound = self.lower_bound
+        remaining = self.pageSize
+        seen_urls = set()
+        while True:
+            self.iterations += 1
+            start_get_file = time.time()
+            last_record, file_names, shards = await data_access.get_files_name(self.sortKey, self.searchKey, self.sortDirection, lower_bound, self.upper_bound, self.media, COLLECTION_NAME, self.filters)
+            self.reading_mongodb_duration += time.time() - start_get_file
+            async for df in self.window_frames(last_record, lower_bound, file_names, shards, by_shard):
+                if len(df.index) == 0:
+                    continue
+                with metrics.stage_timer("dedup", self.media):
+                    duplicated = df.duplicated(subset=["url"], keep='first') | df["url"].isin(seen_urls)
+                    df = df.loc[~duplicated].copy(deep=False)
+                    seen_urls.update(df["url"])
+                remaining -= len(df.index)
+                yield df
+            if remaining <= 0 or len(file_names) == 0:
+                break
+            lower_bound = self.upper_bound + 1
+            self.upper_bound = self.upper_bound + remaining
+        metrics.observe_dedup_iterations(self.media, self.iterations)
+
+async def get_data(searchKey, sortKey, pageSize, pageNumber, sortDirection, media: str, cursor: str = None, fields: list = None, filters: dict = None):
+    initial_lower_bound, first_index = await get_start_position(searchKey, sortKey, pageSize, pageNumber, sortDirection, media, cursor, filters)
+    # Only the requested columns are parsed, url is always needed to find duplicates
+    columns = None if fields is None else list(dict.fromkeys(fields + ["url"]))
     start_time = time.time()
-    end_of_getting_files_name = time.time()
-    while loop:
-        
-        start_get_file = time.time()
-        last_record, file_names, file_names_with_no_rows = await data_access.get_files_name(sortKey, searchKey, sortDirection, lower_bound, upper_bound, media, COLLECTION_NAME)
-        end_get_file = time.time()
-        end_of_getting_files_name += end_get_file - start_get_file
-        df, duplicates_length = await data_access.get_csv_record(last_record, lower_bound, upper_bound, media + 'scrapingbucket', file_names, media + "/")
-        df_sum = pd.concat([df_sum, df], ignore_index=True)
-
-        # Identify and drop duplicates_df, keeping the first occurrence
-        df_sum, duplicated_items = data_access.duplicate_check(df_sum, "url")
-
-        if len(duplicated_items.index) == 0:
-            loop = False
-        else:
-            # If duplicated rows found, save it to duplicates_df
-            duplicates_df = pd.concat([duplicates_df, duplicated_items], ignore_index=True)
-            
-            # When more than 100 duplicates_df, skip a large portion to reduce repetitive results
-            if duplicates_length > 100:
-                lower_bound = upper_bound + duplicates_length + 1
-                upper_bound = upper_bound + duplicates_length + len(duplicated_items) 
-            # If small number, just skip the number of rows of skipped items
-            else:
-                lower_bound = upper_bound + 1
-                upper_bound = upper_bound + len(duplicated_items)
-            
-    # Returns a df with files name containing duplicates_df for further modification
-    files_with_duplicates = duplicates_df.drop_duplicates(subset=["csv_file"], keep='first')
-    
-    df_sum = await data_access.add_index_column(df_sum, initial_lower_bound)
-    df_to_json = df_sum.to_json(orient = "records")
-    data = json.loads(df_to_json)
-
-    
-    background_tasks.add_task(delete_file_with_no_rows, file_names_with_no_rows, media)
-    background_tasks.add_task(remove_duplicates, files_with_duplicates, media)
-    end_time = time.time()
-    return data, start_time, end_time, end_of_getting_files_name
-
-async def remove_duplicates(df: pd.DataFrame, media: str):
-    for index, row in df.iterrows():
-        file_name = row['csv_file']
-        # Remove S3 file
-        response = await data_access.remove_duplicates_from_csv(file_name, media + 'scrapingbucket', media + "/")
-        # If success, change metadata
-        if response["success"] and not response["skip"]:
-            row_count = response["row_count"]
-
-             # If updating metadata is unsuccessful, try for 5 times and update error log
-            success = False
-            failure_count = 0
-            while not success:
-                print("Modifying csv files...")
-                response = await data_access.update_meta_data(file_name, row_count, media, COLLECTION_NAME)
-                success = response["success"]
-                if failure_count > 5 and not success:
-                    log_utils.write_log("Update csv file while failing to update metadata with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
-                    break
-                failure_count += 1
-            await log_utils.write_log("Successfully updated csv file with meta data, file name: " + str(file_name)+ "\n", "log.txt")
-        elif not response["skip"]:
-            log_utils.write_log("Failed to upload modified csv file with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
-
-async def delete_file_with_no_rows(file_names_with_no_rows: [str], media: str):
-    for file_name in file_names_with_no_rows:
-        response = await data_access.remove_csv(file_name, media + 'scrapingbucket', media + "/")
-        # If success, change metadata
-        if response["success"]:
-             # If updating metadata is unsuccessful, try for 5 times and update error log
-            success = False
-            failure_count = 0
-            while not success:
-                print("Deleting zero rows csv files...")
-                response = await data_access.delete_meta_data(file_name, media, COLLECTION_NAME)
-                success = response["success"]
-                if failure_count > 5 and not success:
-                    log_utils.write_log("Deleted csv file while failing to update metadata with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
-                    break
-                failure_count += 1
-            await log_utils.write_log("Successfully deleted csv file and its meta data, file name: " + str(file_name)+ "\n", "log.txt")
-        else:
-            log_utils.write_log("Failed to delete csv file with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
\ No newline at end of file
+    reader = PageReader(searchKey, sortKey, pageSize, sortDirection, media, initial_lower_bound, columns, filters)
+    df_sum = schemas.concat_frames([df async for df in reader.rows()])
+    df_sum = project_columns(df_sum, fields)
+
+    # Serialized once with the response model, see build_page
+    data = await data_access.add_index_column(df_sum, first_index)
+    upper_bound = reader.upper_bound
+    next_cursor = await data_access.get_next_cursor(upper_bound, first_index + len(data.index), sortKey, searchKey, sortDirection, media, COLLECTION_NAME, filters)
+    # Crawlers ask for the following page next
+    prefetch.schedule(media, data_access.prefetch_shards, sortKey, searchKey, sortDirection, upper_bound + 1, upper_bound + pageSize, media, COLLECTION_NAME, filters)
+    metrics.ROWS_SERVED.labels(media).inc(len(data.index))
+
+    durations = {"total_duration": time.time() - start_time, "reading_mongodb_duration": reader.reading_mongodb_duration, "reading_s3_duration": reader.reading_s3_duration}
+    return data, durations, next_cursor
+
+# Same page as get_data as NDJSON lines, generated shard by shard so that memory is bounded by a
+# shard instead of the page size. The last line is {"next_cursor": ...}.
+async def stream_data(searchKey, sortKey, pageSize, pageNumber, sortDirection, media: str, cursor: str = None, fields: list = None, model=None, filters: dict = None):
+    request_timing.mark_data_request()
+    # Invalid input is reported before the response starts
+    lower_bound, first_index = await get_start_position(searchKey, sortKey, pageSize, pageNumber, sortDirection, media, cursor, filters)
+    columns = None if fields is None else list(dict.fromkeys(fields + ["url"]))
+
+    async def generate_rows(next_index):
+        reader = PageReader(searchKey, sortKey, pageSize, sortDirection, media, lower_bound, columns, filters)
+        async for df in reader.rows(by_shard=True):
+            df = project_columns(df, fields)
+            df = await data_access.add_index_column(df, next_index)
+            next_index += len(df.index)
+            if len(df.index) > 0:
+                metrics.ROWS_SERVED.labels(media).inc(len(df.index))
+                with metrics.stage_timer("serialization", media):
+                    lines = serialization.encode_lines(df, model)
+                yield lines
+        next_cursor = await data_access.get_next_cursor(reader.upper_bound, next_index, sortKey, searchKey, sortDirection, media, COLLECTION_NAME, filters)
+        yield serialization.dumps({"next_cursor": next_cursor}) + b"\n"
+
+    return generate_rows(first_index)
+
+# Identical pages requested at the same time are built once
+page_builds = SingleFlight()
+
+# JSON response of a data page, served from the response cache while the metadata of the media
+# does not change. The envelope of a cached page keeps the durations of the request that built it.
+async def get_page_response(searchKey, sortKey, pageSize, pageNumber, sortDirection, media: str, cursor: str = None, fields: list = None, model=None, filters: dict = None):
+    request_timing.mark_data_request()
+    key = response_cache.page_key(media, sortKey, searchKey, sortDirection, pageSize, pageNumber, cursor, fields, filters)
+    if response_cache.cache is not None:
+        body = response_cache.cache.get(key)
+        if body is not None:
+            return Response(content=body, media_type="application/json", headers={"X-Cache": "HIT"})
+    version = response_cache.get_version(media)
+    body = await page_builds.do((key, version), build_page, searchKey, sortKey, pageSize, pageNumber, sortDirection, media, cursor, fields, model, filters)
+    if response_cache.cache is not None:
+        response_cache.cache.put(key, version, body)
+        return Response(content=body, media_type="application/json", headers={"X-Cache": "MISS"})
+    return Response(content=body, media_type="application/json")
+
+# Body of a data page, the rows are encoded once from the DataFrame instead of going through
+# json.loads and a per-row pydantic validation
+async def build_page(searchKey, sortKey, pageSize, pageNumber, sortDirection, media: str, cursor: str = None, fields: list = None, model=None, filters: dict = None):
+    data, durations, next_cursor = await get_data(searchKey, sortKey, pageSize, pageNumber, sortDirection, media, cursor, fields, filters)
+    with metrics.stage_timer("serialization", media):
+        return serialization.encode_response(dict(durations, next_cursor=next_cursor), data, model)
+
+# Aggregates of a media merged from the rollups of its shards, see utils/shard_stats.py. Shards
+# without a rollup are not counted, their number is returned as shards_without_rollup.
+async def get_stats(media: str, group_by: str, searchKey: str = None, from_: str = None, to: str = None):
+    if group_by not in shard_stats.GROUP_BY:
+        raise Exception("Invalid input of group_by, please choose from " + ", ".join(shard_stats.GROUP_BY) + ".")
+    if searchKey == "":
+        raise Exception("Invalid input of searchKey, please do not enter nothing in query parameter or use URL encoded characters for special characters.")
+    filters = parse_filters(None, from_, to) or {}
+    start_time = time.time()
+    documents = [document async for document in data_access.find_meta_data(data_access.MongoClient['scraping'][COLLECTION_NAME], None, searchKey, None, media, {"search_keys": 1, "rollup": 1})]
+    with_rollup = [document for document in documents if document.get("rollup") is not None]
+    from_day = None if filters.get("from") is None else filters["from"][:10]
+    to_day = None if filters.get("to") is None else filters["to"][:10]
+    totals, data = await run_in_thread(shard_stats.merge_rollups, with_rollup, group_by, from_day, to_day)
+    return {
+        "total_duration": time.time() - start_time,
+        "group_by": group_by,
+        "total_count": totals["count"],
+        "total_likes": totals["likes"],
+        "shards": len(with_rollup),
+        "shards_without_rollup": len(documents) - len(with_rollup),
+        "data": data,
+    }
+
+# Query of an export job, the same parameters as the data pages without the page
+class ExportRequest(BaseModel):
+    model_config = ConfigDict(populate_by_name=True)
+
+    sortKey: Optional[str] = None
+    searchKey: Optional[str] = None
+    sortDirection: Optional[str] = "asc"
+    fields: Optional[str] = None
+    text: Optional[str] = None
+    from_: Optional[str] = Field(default=None, alias="from")
+    to: Optional[str] = None
+    min_likes: Optional[int] = None
+    format: str = "csv"
+    compression: str = "gzip"
+
+# Start an export job of every row of the query, see utils/export.py
+async def create_export(media: str, request: ExportRequest, api_key: str, model):
+    if request.searchKey == "" or request.sortKey == "":
+        raise Exception("Invalid input of searchKey or sortKey, please do not enter nothing in query parameter or use URL encoded characters for special characters.")
+    query = {
+        "sortKey": request.sortKey,
+        "searchKey": request.searchKey,
+        "sortDirection": request.sortDirection,
+        "fields": parse_fields(request.fields, model),
+        "filters": parse_filters(request.text, request.from_, request.to, request.min_likes),
+    }
+    job_id = await export.create_job(api_key, media, query, request.format, request.compression, model)
+    return {"job_id": job_id, "status": "queued"}
@@ -1,14 +1,14 @@
 import pandas as pd
 
 from pydantic import BaseModel, Field
-from fastapi import APIRouter, Depends, Query, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, Query, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from starlette import status
 from typing import  Annotated, Optional
-from server.database import MongoClient, SessionLocal
-from sqlalchemy.orm import Session
-from .data_access import get_data
+from server.database import MongoClient
+from .data_access import get_page_response, stream_data, parse_fields, parse_filters, get_response_format, get_stats, create_export, ExportRequest
 
-from utils import api_key_utils
+from utils import api_key_utils, export
 class RedditData(BaseModel):
     index: int
     id: Optional[str] = None
@@ -21,33 +21,56 @@ class RedditModel(BaseModel):
     total_duration: Optional[float] = None
     reading_mongodb_duration: Optional[float] = None
     reading_s3_duration: Optional[float] = None
+    next_cursor: Optional[str] = None
     data: list[RedditData]
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-db_dependency = Annotated[Session, Depends(get_db)]
 api_key_dependency = Annotated[str, Depends(api_key_utils.get_api_key_header)]
+# Charged one use before the route runs, refunded when the request fails
+charged_api_key_dependency = Annotated[str, Depends(api_key_utils.consume_api_key_header)]
 
 router = APIRouter(
     prefix='/reddit',
     tags=['reddit']
 )
 
+# response_model only documents the page in OpenAPI, the body is encoded by build_page and serialization.encode_lines
 @router.get("/get_latest_reddit", status_code=status.HTTP_200_OK, response_model=RedditModel)
-async def get_latest_reddit(background_tasks: BackgroundTasks, db: db_dependency, api_key: api_key_dependency, pageSize: int = Query(), pageNumber: int = Query(),  sortKey: str | None = Query(default=None), searchKey: str | None = Query(default=None), sortDirection: str| None = Query(default="asc")):
+async def get_latest_reddit(request: Request, api_key: charged_api_key_dependency, pageSize: int = Query(), pageNumber: int | None = Query(default=None),  sortKey: str | None = Query(default=None), searchKey: str | None = Query(default=None), sortDirection: str| None = Query(default="asc"), cursor: str | None = Query(default=None), fields: str | None = Query(default=None), format: str | None = Query(default=None), text: str | None = Query(default=None), from_: str | None = Query(default=None, alias="from"), to: str | None = Query(default=None), min_likes: int | None = Query(default=None)):
     try:
+        # Rows are sent shard by shard instead of building the whole page in memory
+        if get_response_format(format, request.headers.get("accept")) == "ndjson":
+            rows = await stream_data(searchKey, sortKey, pageSize, pageNumber, sortDirection, "reddit", cursor, parse_fields(fields, RedditData), RedditData, parse_filters(text, from_, to, min_likes))
+            return StreamingResponse(rows, media_type="application/x-ndjson")
         
-        data, start, end_of_getting_csv_files, end_of_getting_files_name = await get_data(searchKey, sortKey, pageSize, pageNumber, sortDirection, "reddit", background_tasks)
-        await api_key_utils.consume_key(db, api_key)
-        return {
-                "total_duration": (end_of_getting_csv_files - start), "reading_mongodb_duration": (end_of_getting_files_name - start), "reading_s3_duration": (end_of_getting_csv_files - end_of_getting_files_name),
-                "data": data
-                }
+        response = await get_page_response(searchKey, sortKey, pageSize, pageNumber, sortDirection, "reddit", cursor, parse_fields(fields, RedditData), RedditData, parse_filters(text, from_, to, min_likes))
+        return response
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+# Counts and likes grouped by day, keyword or likes bin, merged from the rollups of the shards
+@router.get("/stats", status_code=status.HTTP_200_OK)
+async def get_reddit_stats(api_key: charged_api_key_dependency, group_by: str = Query(default="day"), searchKey: str | None = Query(default=None), from_: str | None = Query(default=None, alias="from"), to: str | None = Query(default=None)):
+    try:
+        stats = await get_stats("reddit", group_by, searchKey, from_, to)
+        return stats
     except Exception as e:
         print(e)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+# Every row of a query written to a compressed file in the background, charged per batch of rows
+@router.post("/export", status_code=status.HTTP_202_ACCEPTED)
+async def create_reddit_export(api_key: api_key_dependency, request: ExportRequest):
+    try:
+        return await create_export("reddit", request, api_key, RedditData)
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+# Status of an export job of the API key, with a download link once it is completed
+@router.get("/export/{job_id}", status_code=status.HTTP_200_OK)
+async def get_reddit_export(api_key: api_key_dependency, job_id: str):
+    job = await export.get_job(job_id, api_key)
+    if job is None or job["media"] != "reddit":
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Export job not found.")
+    return job
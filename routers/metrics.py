@@ -0,0 +1,18 @@
+import os
+from fastapi import APIRouter, HTTPException, Request, Response
+from starlette import status
+from utils import metrics
+
+# Scraped by Prometheus. When the metrics_token setting is given, scrapers send it as a bearer token.
+METRICS_TOKEN = os.environ.get('metrics_token')
+
+router = APIRouter(
+    tags=['metrics']
+)
+
+
+@router.get("/metrics", status_code=status.HTTP_200_OK)
+async def get_metrics(request: Request):
+    if METRICS_TOKEN and request.headers.get("authorization") != "Bearer " + METRICS_TOKEN:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Authentication Failed')
+    return Response(content=metrics.expose(), media_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import FileResponse, PlainTextResponse
+from starlette import status
+from typing import Annotated
+from sqlalchemy.orm import Session
+from server.database import SessionLocal
+from server.models import Users
+from utils.auth import get_current_user
+from utils import profiling
+from utils.multithread import run_in_thread
+
+router = APIRouter(
+    prefix='/profiles',
+    tags=['profiles']
+)
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+db_dependency = Annotated[Session, Depends(get_db)]
+user_dependency = Annotated[dict, Depends(get_current_user)]
+
+def check_admin(user: dict, db: Session):
+    if user is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail='Authentication Failed')
+    user_model = db.query(Users).filter(Users.id == user.get('id')).first()
+    if user_model is None or user_model.role != "admin":
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='Profiles are only available to admin users.')
+
+# Requests profiled with the X-Profile header, newest first
+@router.get("", status_code=status.HTTP_200_OK)
+async def get_profiles(user: user_dependency, db: db_dependency):
+    check_admin(user, db)
+    return await run_in_thread(profiling.list_profiles)
+
+# pstats file of a profile, or its top functions by cumulative time with format=text
+@router.get("/{request_id}", status_code=status.HTTP_200_OK)
+async def get_profile(user: user_dependency, db: db_dependency, request_id: str, format: str | None = Query(default=None), limit: int = Query(default=50)):
+    check_admin(user, db)
+    path = profiling.get_profile_path(request_id)
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found.")
+    if format == "text":
+        return PlainTextResponse(await run_in_thread(profiling.profile_text, path, limit))
+    return FileResponse(path, media_type="application/octet-stream", filename=request_id + ".prof")
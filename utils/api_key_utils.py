@@ -2,12 +2,14 @@ from fastapi import APIRouter, Depends, HTTPException, Query
 from server.database import SessionLocal
 from server.models import Users
 from typing import Annotated
+from sqlalchemy import update
 from sqlalchemy.orm import Session
 from server.models import APIKeys
 from fastapi.security.api_key import APIKeyHeader
 from starlette import status
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+from utils import metrics, charge_leases
 
 
 def get_db():
@@ -33,27 +35,46 @@ async def validate_key(db: db_dependency, key: str):
         return {"error": "Failed to validate key."}
 
 
-# Consume Key
-async def consume_key(db: db_dependency, key: str):
+# Consume Key, amount is the number of charges used. The charge is checked and decremented by one
+# conditional UPDATE, so concurrent requests cannot overdraw the key.
+async def consume_key(db: db_dependency, key: str, amount: int = 1):
+    with metrics.stage_timer("api_key_consume"):
+        try:
+            result = db.execute(
+                update(APIKeys)
+                .where(APIKeys.key == key, APIKeys.charge >= amount)
+                .values(charge=APIKeys.charge - amount)
+                .execution_options(synchronize_session=False)
+            )
+            db.commit()
+            if result.rowcount > 0:
+                return {"success": True}
+
+            # Only a refused key is read again, to tell why
+            api_key = db.query(APIKeys).filter(APIKeys.key == key).first()
+            if not api_key:
+                return {"success": False, "error": "Provided key is invalid."}
+            if api_key.charge <= 0:
+                return {"success": False, "error": "This key is expired, please renew key."}
+            return {"success": False, "error": "This key does not have enough charge left, please renew key."}
+        except Exception as e:
+            print(e)
+            db.rollback()
+            return {"success": False, "error": "Failed to use key."}
+
+# Give back charges of a request that failed after its key was consumed
+async def refund_key(db: db_dependency, key: str, amount: int = 1):
     try:
-        response = await validate_key(db, key)
-        key_is_valid = response["success"]
-        if not key_is_valid:
-            return {"error": "Provided key is invalid."}
-        
-        api_key = db.query(APIKeys).filter(APIKeys.key == key).first()
-        if api_key.charge <= 0:
-            return {"success": False, "error": "This key is expired, please renew key."}
-        
-        api_key.charge = api_key.charge - 1
-        db.add(api_key)
+        db.execute(
+            update(APIKeys)
+            .where(APIKeys.key == key)
+            .values(charge=APIKeys.charge + amount)
+            .execution_options(synchronize_session=False)
+        )
         db.commit()
-
-        return {"success": True, "charge": api_key.charge}
     except Exception as e:
         print(e)
-        return {"success": False, "error": "Failed to use key."}
-        
+        db.rollback()
 
 
 # Save Key
@@ -78,9 +99,33 @@ async def save_api_key(db: db_dependency, key: str, charge: int, user: Users):
 api_key_header = APIKeyHeader(name="x-api-key", auto_error=False)
 async def get_api_key_header(db: db_dependency, api_key: Annotated[str, Depends(api_key_header)]):
     response = await validate_key(db, api_key)
-    print(response)
     if not response["success"]:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail=response["error"])
     return api_key
-    
\ No newline at end of file
+    
+
+# header dependency of the data routes, the key is charged one use in a single UPDATE instead of
+# being validated here and consumed by the route. The charge is given back when the request fails,
+# including invalid query parameters, which FastAPI checks after running the dependencies.
+# With api_key_lease_enabled the charge is taken from the lease of the worker, see
+# utils/charge_leases.py.
+async def consume_api_key_header(db: db_dependency, api_key: Annotated[str, Depends(api_key_header)]):
+    if not api_key:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Provided key is invalid.")
+    if charge_leases.ENABLED:
+        response = await charge_leases.consume(api_key)
+    else:
+        response = await consume_key(db, api_key)
+    if not response["success"]:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail=response["error"])
+    try:
+        yield api_key
+    except Exception:
+        if charge_leases.ENABLED:
+            charge_leases.refund(api_key)
+        else:
+            await refund_key(db, api_key)
+        raise
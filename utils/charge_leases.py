@@ -0,0 +1,172 @@
+import os
+import time
+import asyncio
+
+from sqlalchemy import case, update
+
+from server.database import SessionLocal
+from server.models import APIKeys
+from utils import metrics
+from utils.multithread import run_in_thread
+
+# Write-behind charge accounting of the data routes. Instead of an UPDATE per request, a worker
+# leases a block of uses of a key and consumes it in memory. The uses are written to
+# api_keys.charge by a batched UPDATE every FLUSH_SECONDS and on shutdown, and when a lease runs out:
+# the worker then writes the uses of the key, reads its charge again and leases the next block.
+#
+# A lease is never larger than the charge read, so one worker cannot overdraw a key. Workers do not
+# see the uses of each other that are not flushed yet, at most their leases, which are kept under
+# MAX_OVERDRAW / WORKERS: a key is overdrawn by less than MAX_OVERDRAW uses over all the workers.
+ENABLED = os.environ.get('api_key_lease_enabled', 'false').lower() == 'true'
+# Uses leased at a time
+LEASE_SIZE = int(os.environ.get('api_key_lease_size', 100))
+# Uses a key can be overdrawn by over all the workers
+MAX_OVERDRAW = int(os.environ.get('api_key_max_overdraw', 100))
+# Processes serving the api, uvicorn --workers reads WEB_CONCURRENCY too
+WORKERS = int(os.environ.get('api_key_lease_workers', os.environ.get('WEB_CONCURRENCY', 1)))
+FLUSH_SECONDS = float(os.environ.get('api_key_flush_seconds', 5))
+# A lease is given up after this long, so renewed, expired or deleted keys are seen again
+LEASE_SECONDS = float(os.environ.get('api_key_lease_seconds', 60))
+
+def lease_limit():
+    return max(1, min(LEASE_SIZE, MAX_OVERDRAW // max(WORKERS, 1)))
+
+class Lease:
+    def __init__(self, remaining: int):
+        self.remaining = remaining
+        # Uses not written to the database yet, negative after refunds
+        self.used = 0
+        self.expires_at = time.monotonic() + LEASE_SECONDS
+
+    def valid(self):
+        return self.remaining > 0 and time.monotonic() < self.expires_at
+
+# key -> Lease, only read and changed from the event loop
+leases = {}
+locks = {}
+
+# Write the uses of a key and read its charge, None when the key does not exist
+def sync_key(key: str, used: int):
+    db = SessionLocal()
+    try:
+        if used != 0:
+            db.execute(
+                update(APIKeys)
+                .where(APIKeys.key == key)
+                .values(charge=APIKeys.charge - used)
+                .execution_options(synchronize_session=False)
+            )
+        charge = db.query(APIKeys.charge).filter(APIKeys.key == key).scalar()
+        db.commit()
+        return charge
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# Write the uses of many keys in one UPDATE
+def write_usage(usage: dict):
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(APIKeys)
+            .where(APIKeys.key.in_(list(usage)))
+            .values(charge=APIKeys.charge - case(usage, value=APIKeys.key, else_=0))
+            .execution_options(synchronize_session=False)
+        )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+# Take the unwritten uses of a key, they are given back with restore_usage if writing them fails
+def take_usage(key: str):
+    lease = leases.get(key)
+    if lease is None:
+        return 0
+    used, lease.used = lease.used, 0
+    return used
+
+def restore_usage(key: str, used: int):
+    lease = leases.setdefault(key, Lease(0))
+    lease.used += used
+
+async def renew_lease(key: str):
+    used = take_usage(key)
+    try:
+        charge = await run_in_thread(sync_key, key, used)
+    except Exception as e:
+        print(e)
+        restore_usage(key, used)
+        return {"success": False, "error": "Failed to use key."}
+    if charge is None:
+        leases.pop(key, None)
+        return {"success": False, "error": "Provided key is invalid."}
+    lease = leases.get(key)
+    unwritten = lease.used if lease is not None else 0
+    # Uses made while the charge was read are not part of it
+    available = charge - unwritten
+    if available <= 0:
+        if lease is not None:
+            lease.remaining = 0
+        return {"success": False, "error": "This key is expired, please renew key."}
+    renewed = Lease(min(available, lease_limit()))
+    renewed.used = unwritten
+    leases[key] = renewed
+    return {"success": True}
+
+# Use one charge of the key, from its lease when the worker holds one
+async def consume(key: str):
+    with metrics.stage_timer("api_key_consume"):
+        lease = leases.get(key)
+        if lease is None or not lease.valid():
+            lock = locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                lease = leases.get(key)
+                if lease is None or not lease.valid():
+                    response = await renew_lease(key)
+                    if not response["success"]:
+                        return response
+                    lease = leases[key]
+        lease.remaining -= 1
+        lease.used += 1
+        return {"success": True}
+
+# Give back a charge of a request that failed
+def refund(key: str):
+    lease = leases.get(key)
+    if lease is not None:
+        lease.remaining += 1
+        lease.used -= 1
+
+# Write the uses of every key held by the worker in one UPDATE
+async def flush():
+    usage = {}
+    for key in list(leases):
+        used = take_usage(key)
+        if used != 0:
+            usage[key] = used
+    if len(usage) == 0:
+        return
+    try:
+        await run_in_thread(write_usage, usage)
+    except Exception as e:
+        print("Failed to write API key usage: " + str(e))
+        for key, used in usage.items():
+            restore_usage(key, used)
+        return
+    # Expired leases without uses left to write are forgotten
+    now = time.monotonic()
+    for key in [key for key, lease in leases.items() if lease.used == 0 and lease.expires_at <= now]:
+        if key in locks and locks[key].locked():
+            continue
+        leases.pop(key, None)
+        locks.pop(key, None)
+
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(FLUSH_SECONDS)
+        await flush()
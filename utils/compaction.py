@@ -0,0 +1,221 @@
+import os
+import uuid
+import asyncio
+import argparse
+from datetime import datetime
+
+import pandas as pd
+
+from utils import data_access, log_utils, page_map, url_index, shard_stats, text_index
+from utils.multithread import run_in_thread
+from utils.shard_reader import write_shard, FILE_FORMATS
+from utils.metadata_writer import MetadataWriter
+
+# Offline compaction of the shards of a media, so that read requests never rewrite files:
+# shards are read oldest first, rows whose url is in an earlier shard with the same search keys are
+# dropped, consecutive small shards with the same search keys are merged up to the target size,
+# shards left without rows are dropped, and the metadata of every group is swapped in one
+# transaction. The text of the new shards is added to the text index.
+# Run from the root directory: python -m utils.compaction --media reddit
+COLLECTION_NAME = "scraping"
+TARGET_ROWS = int(os.environ.get('compaction_target_rows', 100000))
+# Metadata fields written by compaction, the other fields of a merged shard are copied from the
+# group and only shards agreeing on them are merged, so that sorting on them keeps working
+COMPACTION_FIELDS = {"_id", "file_name", "file_format", "row_count", "unique_row_count", "duplicate_rows", "source_name", "search_keys", "created_at", "rollup"} | set(shard_stats.ZONE_FIELDS)
+
+def get_collection():
+    return data_access.MongoClient['scraping'][COLLECTION_NAME]
+
+# Fields of the metadata document kept as they are by a merge
+def carried_fields(document):
+    return {field: value for field, value in document.items() if field not in COMPACTION_FIELDS}
+
+# Consecutive shards with the same search keys, format and other metadata fields, small ones packed
+# up to target_rows
+def plan_groups(documents, target_rows: int):
+    groups = []
+    group = []
+    group_rows = 0
+    for document in documents:
+        row_count = document.get("row_count", 0)
+        same_kind = len(group) > 0 and group[0].get("search_keys") == document.get("search_keys") and group[0].get("file_format", "csv") == document.get("file_format", "csv") and carried_fields(group[0]) == carried_fields(document)
+        if len(group) > 0 and (not same_kind or group_rows + row_count > target_rows):
+            groups.append(group)
+            group = []
+            group_rows = 0
+        group.append(document)
+        group_rows += row_count
+    if len(group) > 0:
+        groups.append(group)
+    return groups
+
+def compacted_file_name(media: str, file_format: str):
+    return media + "_" + datetime.utcnow().strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:8] + "." + file_format
+
+# Rows of the group whose url was not seen in an earlier shard with the same search keys, and
+# whether any row was dropped
+async def read_group(media: str, group, seen_urls: url_index.UrlIndex):
+    frames = []
+    dropped = False
+    scope = url_index.search_scope(group[0].get("search_keys"))
+    for document in group:
+        df, _ = await run_in_thread(data_access.download_shard, media + 'scrapingbucket', media + "/", document["file_name"], document.get("file_format", "csv"))
+        df = df.drop(columns=["csv_file"])
+        keep = [seen_urls.add(url_index.url_hash(url, scope)) for url in df["url"]]
+        if not all(keep):
+            dropped = True
+            df = df[keep]
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True), dropped
+
+# Replace the metadata of the group by the document of the compacted shard, or remove it when the
+# group has no rows left. Readers see either the old shards or the new one.
+async def swap_meta_data(group, new_document):
+    mongo_collection = get_collection()
+    async with await data_access.MongoClient.start_session() as session:
+        async with session.start_transaction():
+            if new_document is not None:
+                await mongo_collection.insert_one(new_document, session=session)
+            await mongo_collection.delete_many({"_id": {"$in": [document["_id"] for document in group]}}, session=session)
+
+async def compact_group(media: str, group, seen_urls: url_index.UrlIndex, file_format: str, dry_run: bool, writer: MetadataWriter, text: text_index.TextIndex):
+    df, dropped = await read_group(media, group, seen_urls)
+    row_count = len(df.index)
+    if len(group) == 1 and not dropped and row_count > 0:
+        # Nothing to rewrite, the shard is only marked as free of duplicate urls
+        writer.set_fields(group[0]["file_name"], dict(shard_stats.compute_stats(df), unique_row_count=row_count, duplicate_rows=[], rollup=shard_stats.compute_rollup(df)))
+        return [group[0]["file_name"]], []
+
+    new_document = None
+    if row_count > 0:
+        new_file_name = compacted_file_name(media, file_format)
+        new_document = carried_fields(group[0])
+        new_document.update({
+            "file_name": new_file_name,
+            "file_format": file_format,
+            "row_count": row_count,
+            "unique_row_count": row_count,
+            "duplicate_rows": [],
+            "source_name": media,
+            "search_keys": group[0].get("search_keys"),
+            # The group keeps its place in the default created_at order
+            "created_at": max([document["created_at"] for document in group if document.get("created_at") is not None], default=datetime.utcnow()),
+        })
+        new_document.update(shard_stats.compute_stats(df))
+        new_document["rollup"] = shard_stats.compute_rollup(df)
+    print(("Would compact " if dry_run else "Compacting ") + ", ".join(document["file_name"] for document in group) + " into " + (new_document["file_name"] if new_document else "nothing") + " (" + str(row_count) + " rows)")
+    if dry_run:
+        return [new_document["file_name"]] if new_document else [], []
+
+    if new_document is not None:
+        body = await run_in_thread(write_shard, df, file_format)
+        await run_in_thread(data_access.s3_client.put_object, Bucket=media + 'scrapingbucket', Key=media + "/" + new_document["file_name"], Body=body)
+        await run_in_thread(text_index.index_shard, data_access.s3_client, text, media + 'scrapingbucket', media + "/", new_document["file_name"], df)
+    try:
+        await swap_meta_data(group, new_document)
+    except Exception:
+        # The old shards are still the ones in the metadata
+        if new_document is not None:
+            await data_access.remove_csv(new_document["file_name"], media + 'scrapingbucket', media + "/")
+        raise
+    return [new_document["file_name"]] if new_document else [], [document["file_name"] for document in group]
+
+async def compact(media: str, target_rows: int, file_format: str, grace_seconds: float, dry_run: bool):
+    mongo_collection = get_collection()
+    documents = [document async for document in mongo_collection.find({"source_name": media}).sort("created_at", 1)]
+    seen_urls = url_index.UrlIndex()
+    writer = MetadataWriter(media, COLLECTION_NAME)
+    text = await run_in_thread(text_index.load_dictionary, data_access.s3_client, media, False)
+    file_names = []
+    removed_file_names = []
+    complete = True
+    for group in plan_groups(documents, target_rows):
+        try:
+            kept, removed = await compact_group(media, group, seen_urls, file_format, dry_run, writer, text)
+            file_names.extend(kept)
+            removed_file_names.extend(removed)
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to compact shards with error: " + str(e) + ". File names: " + ", ".join(document["file_name"] for document in group) + "\n", "error_log.txt")
+            # Later shards would keep urls that belong to this group
+            complete = False
+            break
+    if dry_run:
+        return
+    for file_name, response in (await writer.flush()).items():
+        if not response["success"]:
+            complete = False
+            log_utils.write_log("Failed to mark shard as compacted with error: " + str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+    page_map.invalidate(media)
+    await run_in_thread(text_index.save_dictionary, data_access.s3_client, media, text)
+    if complete:
+        seen_urls.file_names = set(file_names)
+        await run_in_thread(url_index.save_index, media, seen_urls)
+
+    # Servers keep reading the old shards until their page map expires
+    if len(removed_file_names) > 0:
+        print("Deleting " + str(len(removed_file_names)) + " compacted shards in " + str(grace_seconds) + " seconds")
+        await asyncio.sleep(grace_seconds)
+    for file_name in removed_file_names:
+        await data_access.remove_csv(file_name, media + 'scrapingbucket', media + "/")
+    print("Compacted " + str(len(documents)) + " shards of " + media + " into " + str(len(file_names)))
+
+# Cleanup without transactions, for standalone MongoDB servers: duplicate urls are dropped within
+# each shard in place and shards without rows are deleted. Shards are neither merged nor
+# deduplicated against each other.
+async def compact_in_place(media: str):
+    mongo_collection = get_collection()
+    documents = [document async for document in mongo_collection.find({"source_name": media}, {"file_name": 1, "row_count": 1})]
+    await delete_file_with_no_rows([document["file_name"] for document in documents if document.get("row_count", 0) == 0], media)
+    await remove_duplicates(pd.DataFrame({"csv_file": [document["file_name"] for document in documents if document.get("row_count", 0) > 0]}), media)
+
+async def remove_duplicates(df: pd.DataFrame, media: str):
+    writer = MetadataWriter(media, COLLECTION_NAME)
+    for index, row in df.iterrows():
+        file_name = row['csv_file']
+        # Remove S3 file
+        response = await data_access.remove_duplicates_from_csv(file_name, media + 'scrapingbucket', media + "/")
+        # If success, change metadata with the other files
+        if response["success"] and not response["skip"]:
+            writer.update(file_name, response["row_count"])
+        elif not response["skip"]:
+            log_utils.write_log("Failed to upload modified csv file with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+    print("Modifying metadata of " + str(len(writer)) + " csv files...")
+    for file_name, response in (await writer.flush()).items():
+        if response["success"]:
+            log_utils.write_log("Successfully updated csv file with meta data, file name: " + str(file_name)+ "\n", "log.txt")
+        else:
+            log_utils.write_log("Update csv file while failing to update metadata with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+
+async def delete_file_with_no_rows(file_names_with_no_rows: [str], media: str):
+    writer = MetadataWriter(media, COLLECTION_NAME)
+    for file_name in file_names_with_no_rows:
+        response = await data_access.remove_csv(file_name, media + 'scrapingbucket', media + "/")
+        # If success, change metadata with the other files
+        if response["success"]:
+            writer.delete(file_name)
+        else:
+            log_utils.write_log("Failed to delete csv file with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+    print("Deleting metadata of " + str(len(writer)) + " zero rows csv files...")
+    for file_name, response in (await writer.flush()).items():
+        if response["success"]:
+            log_utils.write_log("Successfully deleted csv file and its meta data, file name: " + str(file_name)+ "\n", "log.txt")
+        else:
+            log_utils.write_log("Deleted csv file while failing to update metadata with error: " +  str(response["msg"]) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--media", required=True, choices=["reddit", "twitter", "test"])
+    parser.add_argument("--target-rows", type=int, default=TARGET_ROWS, help="rows of a merged shard")
+    parser.add_argument("--format", default="csv", choices=FILE_FORMATS, help="format of the merged shards")
+    parser.add_argument("--grace-seconds", type=float, default=max(page_map.PAGE_MAP_TTL, page_map.PAGE_MAP_LATEST_TTL), help="wait before deleting compacted shards, servers read them until their page map expires")
+    parser.add_argument("--dry-run", action="store_true", help="print the groups without writing anything")
+    parser.add_argument("--in-place", action="store_true", help="only drop duplicates within each shard and delete empty shards, for MongoDB servers without transactions")
+    args = parser.parse_args()
+    if args.in_place:
+        asyncio.run(compact_in_place(args.media))
+    else:
+        asyncio.run(compact(args.media, args.target_rows, args.format, args.grace_seconds, args.dry_run))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import asyncio
+import argparse
+
+from utils import data_access, log_utils, text_index
+from utils.multithread import run_in_thread
+from utils.shard_reader import read_shard, write_shard, shard_file_name
+
+# Rewrite the csv shards of a media as parquet and point their metadata to the new files. The new
+# files are added to the text index.
+# Run from the root directory: python -m utils.convert_shards --media reddit
+COLLECTION_NAME = "scraping"
+
+async def convert_shard(document, media: str, file_format: str, delete_source: bool, text: text_index.TextIndex):
+    bucket_name = media + 'scrapingbucket'
+    prefix = media + "/"
+    file_name = document["file_name"]
+    new_file_name = shard_file_name(file_name, file_format)
+
+    obj = await run_in_thread(data_access.s3_client.get_object, Bucket=bucket_name, Key=prefix + file_name)
+    df = await run_in_thread(read_shard, obj['Body'], document.get("file_format", "csv"))
+    body = await run_in_thread(write_shard, df, file_format)
+    await run_in_thread(data_access.s3_client.put_object, Bucket=bucket_name, Key=prefix + new_file_name, Body=body)
+    await run_in_thread(text_index.index_shard, data_access.s3_client, text, bucket_name, prefix, new_file_name, df)
+
+    # Readers switch to the new file once the metadata changes, the old file is kept until then
+    mongo_collection = data_access.MongoClient['scraping'][COLLECTION_NAME]
+    await mongo_collection.update_one({"_id": document["_id"]}, {"$set": {"file_name": new_file_name, "file_format": file_format, "row_count": len(df.index)}})
+    if delete_source and new_file_name != file_name:
+        await data_access.remove_csv(file_name, bucket_name, prefix)
+    return len(body)
+
+async def convert(media: str, file_format: str, limit: int, delete_source: bool):
+    mongo_collection = data_access.MongoClient['scraping'][COLLECTION_NAME]
+    results = mongo_collection.find({"source_name": media, "file_format": {"$in": [None, "csv"]}})
+    if limit is not None:
+        results = results.limit(limit)
+    converted = 0
+    text = await run_in_thread(text_index.load_dictionary, data_access.s3_client, media, False)
+    async for document in results:
+        try:
+            size = await convert_shard(document, media, file_format, delete_source, text)
+            converted += 1
+            print("Converted " + document["file_name"] + " (" + str(size) + " bytes)")
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to convert shard to " + file_format + " with error: " + str(e) + ". File name: " + str(document["file_name"]) + "\n", "error_log.txt")
+    await run_in_thread(text_index.save_dictionary, data_access.s3_client, media, text)
+    print("Converted " + str(converted) + " shards of " + media)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--media", required=True, choices=["reddit", "twitter", "test"])
+    parser.add_argument("--format", default="parquet", choices=["parquet"])
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--delete-source", action="store_true", help="delete the csv file after its metadata points to the new shard")
+    args = parser.parse_args()
+    asyncio.run(convert(args.media, args.format, args.limit, args.delete_source))
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import os
+import asyncio
+import bisect
 import boto3
 from pymongo.collation import Collation
 import pandas as pd
@@ -6,8 +8,12 @@ import pandas as pd
 from server.database import MongoClient
 from sqlalchemy.orm import Session
 
-from utils.multithread import parallel_multithreading
+from utils.multithread import parallel_async, run_in_thread
 from utils.timer import timing
+from utils import page_map, pagination, shard_index, shard_cache, prefetch, text_index, shard_stats, schemas, metrics, request_timing
+from utils.shard_reader import read_shard, write_shard, file_format_of, project_columns
+from utils.metadata_writer import MetadataWriter
+from utils.single_flight import ThreadSingleFlight
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -23,92 +29,298 @@ s3_client = session.client('s3',
                 aws_access_key_id=ACCESS_KEY,
                 aws_secret_access_key=SECRET_KEY)
 
-@timing
-async def get_files_name(sortKey, searchKey, sortDirection, lower_bound, upper_bound, source_name, collection):
-    try:
-        mongo_collection = MongoClient['scraping'][collection]
-        first_row_number_of_file = 0
-        last_row_number_of_file = 0
-        sortDir = 1
-        if sortDirection == "desc":
-            sortDir = -1
-        # Filter and sort csv metadata to choose which appropriate csv to fetch
-        if sortKey is not None and searchKey is not None:
-            results = mongo_collection.find({"source_name":source_name, "search_keys":[searchKey]}).collation(Collation(locale='en_US', strength=1)).sort(sortKey, sortDir)
-        elif sortKey is not None:
-            results = mongo_collection.find({"source_name":source_name }).sort(sortKey, sortDir)
-        elif searchKey is not None:
-            results = mongo_collection.find({"source_name":source_name, "search_keys":[searchKey]}).collation(Collation(locale='en_US', strength=1))
+shard_downloads = ThreadSingleFlight()
+
+# Filter and sort csv metadata to choose which appropriate csv to fetch
+# conditions are other conditions of the query, such as the statistics of range filters
+def find_meta_data(mongo_collection, sortKey, searchKey, sortDirection, source_name, projection=None, conditions=None):
+    sortDir = 1
+    if sortDirection == "desc":
+        sortDir = -1
+    query = {"source_name":source_name }
+    if searchKey is not None:
+        query["search_keys"] = [searchKey]
+    query.update(conditions or {})
+    if sortKey is not None and searchKey is not None:
+        return mongo_collection.find(query, projection).collation(Collation(locale='en_US', strength=1)).sort(sortKey, sortDir)
+    elif sortKey is not None:
+        return mongo_collection.find(query, projection).sort(sortKey, sortDir)
+    elif searchKey is not None:
+        return mongo_collection.find(query, projection).collation(Collation(locale='en_US', strength=1))
+    else:
+        return mongo_collection.find(query, projection).sort("created_at", -1)
+
+PAGE_MAP_PROJECTION = {"file_name": 1, "row_count": 1, "file_format": 1, "unique_row_count": 1, "duplicate_rows": 1}
+
+# Row count used for paging and the other metadata a page needs to read the file
+def page_map_document(document):
+    attributes = {}
+    if document.get("file_format") is not None:
+        attributes["file_format"] = document["file_format"]
+    row_count = document["row_count"]
+    attributes["file_row_count"] = row_count
+    # Files processed by the url index only count rows whose url is not in an earlier file
+    if document.get("unique_row_count") is not None:
+        row_count = document["unique_row_count"]
+        attributes["duplicate_rows"] = document.get("duplicate_rows") or []
+    # Statistics, only projected for range filters
+    zone = {field: document[field] for field in shard_stats.ZONE_FIELDS if document.get(field) is not None}
+    if len(zone) > 0:
+        attributes["zone"] = zone
+    return document["file_name"], row_count, attributes
+
+# Scan the sorted metadata once to build the row offsets, later pages are resolved by binary search.
+# With filters the rows are the matching rows, see utils/shard_stats.py for the range filters and
+# utils/text_index.py for the "text" filter.
+async def get_page_map(sortKey, searchKey, sortDirection, source_name, collection, filters=None):
+    mongo_collection = MongoClient['scraping'][collection]
+
+    async def load_row_counts():
+        with metrics.stage_timer("metadata_scan", source_name):
+            return await scan_row_counts()
+
+    async def scan_row_counts():
+        if shard_stats.has_zone_filters(filters):
+            results = find_meta_data(mongo_collection, sortKey, searchKey, sortDirection, source_name, {**PAGE_MAP_PROJECTION, **shard_stats.ZONE_PROJECTION}, shard_stats.zone_query(filters))
+            documents = shard_stats.mark_partial([page_map_document(cursor) async for cursor in results], filters)
         else:
-            results = mongo_collection.find({"source_name":source_name }).sort("created_at", -1)
-        
-        # Get files name of required csv of selected page
-        
-        file_names = []
-        file_names_with_no_rows = []
+            results = find_meta_data(mongo_collection, sortKey, searchKey, sortDirection, source_name, PAGE_MAP_PROJECTION)
+            documents = [page_map_document(cursor) async for cursor in results]
+        if filters and filters.get("text") is not None:
+            documents = await text_index.match_documents(s3_client, source_name, documents, filters["text"])
+        return documents
 
-        # Async for doesn't parallelize the iteration, but using a async source to run
+    key = page_map.page_map_key(source_name, sortKey, sortDirection, searchKey, filters)
+    return await page_map.get_page_map(key, load_row_counts)
 
-        async for cursor in results:
-            #print(cursor)
-            # skip small data files / 0 row files
-            if int(cursor["row_count"]) == 0:
-                file_names_with_no_rows.append(cursor["file_name"])
-                continue
-            if searchKey is None and int(cursor["row_count"]) <= 0:
-                continue
-            
-            first_row_number_of_file = last_row_number_of_file + 1
-            last_row_number_of_file = first_row_number_of_file + int(cursor["row_count"]) - 1
-            if first_row_number_of_file > upper_bound:
-                last_row_number_of_file = first_row_number_of_file - 1
-                break
-            if last_row_number_of_file < lower_bound:
-                continue
-            
-            else:
-                file_names.append(cursor["file_name"])
-        #print(file_names)
-        return last_row_number_of_file, file_names, file_names_with_no_rows
+# Columns of a whole shard needed by the filters. They are read past the shard cache, so that
+# scanning the shards of a filter does not push the popular shards out of it.
+def download_filter_columns(bucket_name, key, file_format="csv", columns=None):
+    media = schemas.media_of(bucket_name)
+    with metrics.stage_timer("shard_download", media):
+        data = s3_client.get_object(Bucket=bucket_name, Key=key)['Body'].read()
+    metrics.add_bytes_fetched(media, len(data))
+    with metrics.stage_timer("parse", media):
+        return read_shard(data, file_format, columns, media)
+
+# Settle the pending files of a filtered page map that come before row, or hold it. Settling only
+# lowers row counts, which moves row into later files, so this repeats until none is pending there.
+async def settle_rows(current_page_map, source_name, filters, row):
+    if len(current_page_map.pending) == 0:
+        return
+    bucket_name = source_name + 'scrapingbucket'
+
+    def match_rows(file_name):
+        attributes = current_page_map.get_attributes(file_name)
+        key = source_name + "/" + file_name
+        file_format = attributes.get("file_format", "csv")
+        # Shards missing from the text index have their text column scanned
+        columns = (shard_stats.FILTER_COLUMNS if shard_stats.has_zone_filters(filters) else []) + (["text"] if attributes.get("scan_text") else [])
+        df = shard_downloads.do((bucket_name, key, file_format, "filter", tuple(columns)), download_filter_columns, bucket_name, key, file_format, columns)
+        rows = shard_stats.match_rows(df, filters, attributes)
+        if attributes.get("scan_text"):
+            rows = text_index.scan_rows(df["text"] if "text" in df.columns else pd.Series("", index=df.index), filters["text"], set(rows))
+        return rows
+
+    async with current_page_map.settle_lock:
+        while True:
+            file_names = current_page_map.pending_until(current_page_map.search(row))
+            if len(file_names) == 0:
+                return
+            for file_name, rows in zip(file_names, await parallel_async(match_rows, file_names)):
+                current_page_map.settle(file_name, rows)
+
+@timing
+async def get_files_name(sortKey, searchKey, sortDirection, lower_bound, upper_bound, source_name, collection, filters=None):
+    try:
+        current_page_map = await get_page_map(sortKey, searchKey, sortDirection, source_name, collection, filters)
+        await settle_rows(current_page_map, source_name, filters, upper_bound)
+
+        # Get files name of required csv of selected page
+        last_row_number_of_file, file_names = current_page_map.resolve(lower_bound, upper_bound)
+        shards = []
+        for file_name in file_names:
+            attributes = current_page_map.get_attributes(file_name)
+            shards.append({
+                "row_count": current_page_map.row_counts[current_page_map.positions[file_name]],
+                "file_format": attributes.get("file_format", "csv"),
+                "duplicate_rows": attributes.get("duplicate_rows", []),
+                "rows": attributes.get("rows"),
+            })
+        return last_row_number_of_file, file_names, shards
     except Exception as e:
         print("Error: fail to fetch data from Mongodb database.")
         print(e)
         raise Exception("Error: fail to fetch data from Mongodb database. Message: " + str(e))
 
+# Row number and index watermark where the page of a continuation token starts
+async def get_cursor_position(cursor: str, sortKey, searchKey, sortDirection, source_name, collection, filters=None):
+    query = pagination.query_fingerprint(source_name, sortKey, searchKey, sortDirection, filters)
+    file_name, offset, watermark, row = pagination.decode_cursor(cursor, query)
+    current_page_map = await get_page_map(sortKey, searchKey, sortDirection, source_name, collection, filters)
+    row_number = current_page_map.row_number(file_name, offset)
+    if row_number is not None and len(current_page_map.pending) > 0:
+        await settle_rows(current_page_map, source_name, filters, row_number)
+        row_number = current_page_map.row_number(file_name, offset)
+    # File was deleted since the token was issued
+    if row_number is None:
+        row_number = row
+    return row_number, watermark
+
+# Continuation token of the page following last_row, None if there are no more rows
+async def get_next_cursor(last_row: int, watermark: int, sortKey, searchKey, sortDirection, source_name, collection, filters=None):
+    current_page_map = await get_page_map(sortKey, searchKey, sortDirection, source_name, collection, filters)
+    await settle_rows(current_page_map, source_name, filters, last_row + 1)
+    file_name, offset = current_page_map.locate(last_row + 1)
+    if file_name is None:
+        return None
+    query = pagination.query_fingerprint(source_name, sortKey, searchKey, sortDirection, filters)
+    return pagination.encode_cursor(file_name, offset, watermark, last_row + 1, query)
+
+# Raw row number of the effective row of a file, duplicate_rows is sorted
+def raw_row_number(row, duplicate_rows):
+    for duplicate_row in duplicate_rows:
+        if duplicate_row > row:
+            break
+        row += 1
+    return row
+
+# Download one shard in a worker thread, returns the rows read and the row number of the first one.
+# end_row is None to read up to the end of file. Rows listed in duplicate_rows are dropped and the
+# row numbers count the remaining rows only. When rows is given, only these rows of the file are
+# read and the row numbers are positions in rows.
+def download_shard(bucket_name, prefix, key, file_format="csv", start_row=0, end_row=None, columns=None, duplicate_rows=None, rows=None):
+    if rows is not None:
+        selected = rows[start_row:end_row]
+        df, first_row = read_shard_rows(bucket_name, prefix, key, file_format, selected[0] if selected else 0, selected[-1] + 1 if selected else 0, columns)
+        df = df.iloc[[row - first_row for row in selected]].reset_index(drop=True)
+        return df, start_row
+    if not duplicate_rows:
+        return read_shard_rows(bucket_name, prefix, key, file_format, start_row, end_row, columns)
+    raw_end_row = None if end_row is None else raw_row_number(end_row, duplicate_rows)
+    df, first_row = read_shard_rows(bucket_name, prefix, key, file_format, raw_row_number(start_row, duplicate_rows), raw_end_row, columns)
+    positions = pd.RangeIndex(first_row, first_row + len(df.index))
+    df = df[~positions.isin(duplicate_rows)].reset_index(drop=True)
+    return df, first_row - bisect.bisect_left(duplicate_rows, first_row)
+
+def read_shard_rows(bucket_name, prefix, key, file_format="csv", start_row=0, end_row=None, columns=None):
+    request_timing.add("shard_count")
+    # Popular shards are served from the local cache
+    if shard_cache.cache is not None:
+        df = shard_cache.cache.get(s3_client, bucket_name, prefix + key, file_format)
+        if df is not None:
+            prefetch.record_read(bucket_name, prefix + key)
+            df = project_columns(df, columns)
+            return schemas.tag_file(df, key), 0
+    # Only the rows of the page are needed, try a ranged GET through the sidecar index
+    if shard_index.ENABLED and file_format == "csv" and (start_row > 0 or end_row is not None):
+        result = shard_index.read_rows(s3_client, bucket_name, prefix + key, start_row, end_row if end_row is not None else float("inf"), columns)
+        if result is not None:
+            df, first_row = result
+            return schemas.tag_file(df, key), first_row
+    # Requests reading the same shard at the same time share one GET
+    parsed_columns = None if shard_cache.cache is not None or columns is None else tuple(columns)
+    df = shard_downloads.do((bucket_name, prefix + key, file_format, parsed_columns), download_full_shard, bucket_name, prefix + key, file_format, parsed_columns)
+    df = project_columns(df.copy(deep=False), columns)
+    return schemas.tag_file(df, key), 0
+
+# Whole shard, parsed with all columns when it goes to the shard cache
+def download_full_shard(bucket_name, key, file_format="csv", columns=None):
+    media = schemas.media_of(bucket_name)
+    with metrics.stage_timer("shard_download", media):
+        obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+        data = obj['Body'].read()
+    metrics.add_bytes_fetched(media, len(data))
+    if shard_index.ENABLED and file_format == "csv":
+        shard_index.ensure_index(s3_client, bucket_name, key, data, obj['ETag'])
+    # The whole shard is cached so that any later projection can be served from it
+    with metrics.stage_timer("parse", media):
+        df = read_shard(data, file_format, None if shard_cache.cache is not None else columns, media)
+    metrics.ROWS_FETCHED.labels(media or "").inc(len(df.index))
+    if shard_cache.cache is not None:
+        shard_cache.cache.put(bucket_name, key, data, obj['ETag'], file_format, df)
+    return df
+
+# Warm the shard cache with the shards of rows [lower_bound, upper_bound], see utils/prefetch.py
+async def prefetch_shards(sortKey, searchKey, sortDirection, lower_bound, upper_bound, source_name, collection, filters=None):
+    bucket_name = source_name + 'scrapingbucket'
+    prefix = source_name + "/"
+    source_stats = prefetch.get_source_stats(source_name)
+    try:
+        _, file_names, shards = await get_files_name(sortKey, searchKey, sortDirection, lower_bound, upper_bound, source_name, collection, filters)
+        for file_name, shard in zip(file_names, shards):
+            key = prefix + file_name
+            if shard_cache.cache.contains(bucket_name, key):
+                source_stats["already_cached"] += 1
+                continue
+            await prefetch.run_in_prefetch_thread(shard_downloads.do, (bucket_name, key, shard["file_format"], None), download_full_shard, bucket_name, key, shard["file_format"])
+            prefetch.mark_prefetched(source_name, bucket_name, key)
+    except Exception as e:
+        source_stats["errors"] += 1
+        print("Failed to prefetch shards: " + str(e))
+
+# Rows [start_row, end_row) of each file belonging to [lower_bound, upper_bound], end_row is None up to the end of file
+def get_row_windows(last_row_number_of_file: int, lower_bound: int, upper_bound: int, shards):
+    windows = []
+    row_counts = [shard["row_count"] for shard in shards]
+    first_row_number_of_file = last_row_number_of_file - sum(row_counts) + 1
+    for row_count in row_counts:
+        start_row = max(lower_bound - first_row_number_of_file, 0)
+        end_row = min(upper_bound - first_row_number_of_file + 1, row_count)
+        windows.append((start_row, None if end_row == row_count else end_row))
+        first_row_number_of_file += row_count
+    return windows
+
+def cut_rows(df, first_row, start_row, end_row):
+    return df.iloc[start_row - first_row:None if end_row is None else end_row - first_row]
+
 @timing
-async def get_csv_record(last_row_number_of_file: int, lower_bound : int, upper_bound: int, bucket_name, file_names, prefix):
+async def get_csv_record(last_row_number_of_file: int, lower_bound : int, upper_bound: int, bucket_name, file_names, prefix, shards, columns=None):
     try:
-        df = pd.DataFrame()
-        
-        # Define Method for each csv file
-        def download_object(key):
-            obj = s3_client.get_object(Bucket=bucket_name, Key=prefix + key)
-            df = pd.read_csv(obj['Body'])
-            
-            df['csv_file'] = key
-            return df
-        
-        for result in parallel_multithreading(download_object, file_names):
-            df = pd.concat([df, result], ignore_index=True)
-        
-        # Get the length of duplicate in file only
-        duplicates = df[df.duplicated(subset=["url"], keep='first')]
-        duplicates_length = len(duplicates.index)
-        
-
-        # Cut the irrelevant rows for response
-        total_length = len(df.index)
-        cut_tail = max(last_row_number_of_file - upper_bound, 0)
-        df.drop(df.tail(cut_tail).index, inplace = True)
-        cut_start = max(total_length - (last_row_number_of_file - lower_bound) - 1, 0)
-        df.drop(index=df.index[:cut_start], inplace=True)
-        
-        #df = add_index_column(df, lower_bound)
-        return df, duplicates_length
+        windows = get_row_windows(last_row_number_of_file, lower_bound, upper_bound, shards)
+
+        def download_object(args):
+            key, shard, (start_row, end_row) = args
+            return download_shard(bucket_name, prefix, key, shard["file_format"], start_row, end_row, columns, shard["duplicate_rows"], shard["rows"])
+
+        # Downloads run in the shared executor so other requests keep being served meanwhile
+        args = list(zip(file_names, shards, windows))
+        results = await parallel_async(download_object, args)
+        if len(results) == 0:
+            return pd.DataFrame()
+        # Cut the irrelevant rows for response, the shards are concatenated once
+        return schemas.concat_frames([cut_rows(result, first_row, start_row, end_row) for (result, first_row), (start_row, end_row) in zip(results, windows)])
     except Exception as e:
         print("Error: fail to get csv files from Wasabi bucket.")
         raise Exception("Error: fail to get csv files from Wasabi bucket. Message: " + str(e))
 
+# Same rows as get_csv_record, yielded shard by shard so that only the next shard is held besides the current one
+async def iterate_csv_records(last_row_number_of_file: int, lower_bound : int, upper_bound: int, bucket_name, file_names, prefix, shards, columns=None):
+    windows = get_row_windows(last_row_number_of_file, lower_bound, upper_bound, shards)
+
+    def start_download(position):
+        if position >= len(file_names):
+            return None
+        start_row, end_row = windows[position]
+        shard = shards[position]
+        return asyncio.ensure_future(run_in_thread(download_shard, bucket_name, prefix, file_names[position], shard["file_format"], start_row, end_row, columns, shard["duplicate_rows"], shard["rows"]))
+
+    next_download = start_download(0)
+    try:
+        for position in range(len(file_names)):
+            current_download = next_download
+            next_download = start_download(position + 1)
+            try:
+                result, first_row = await current_download
+            except Exception as e:
+                print("Error: fail to get csv files from Wasabi bucket.")
+                raise Exception("Error: fail to get csv files from Wasabi bucket. Message: " + str(e))
+            start_row, end_row = windows[position]
+            yield cut_rows(result, first_row, start_row, end_row)
+    finally:
+        if next_download is not None:
+            next_download.cancel()
+
 async def add_index_column(df, lower_bound):
     # Add index column to first column
     current_df_length = len(df.index)
@@ -133,8 +345,9 @@ def duplicate_check(df:pd.DataFrame, subset: str):
 
 async def remove_duplicates_from_csv(file_name: str, bucket_name: str, prefix):
     # get file from s3
-    obj = s3_client.get_object(Bucket=bucket_name, Key=prefix + file_name)
-    df = pd.read_csv(obj['Body'])
+    obj = await run_in_thread(s3_client.get_object, Bucket=bucket_name, Key=prefix + file_name)
+    file_format = file_format_of(file_name)
+    df = await run_in_thread(read_shard, obj['Body'], file_format)
 
     original_length = len(df)
 
@@ -147,38 +360,35 @@ async def remove_duplicates_from_csv(file_name: str, bucket_name: str, prefix):
         print("skip updating csv since no rows changed.")
         return {"success": True, "row_count": len(df), "skip": True}
     try:
-        print("write to csv")
-        df.to_csv("tmp/" + file_name, index=False)
-        s3_client.upload_file(Key=prefix + file_name, Bucket=bucket_name, Filename="tmp/" + file_name)
-        await os.remove("tmp/" + file_name)
+        print("write to " + file_format)
+        await run_in_thread(s3_client.put_object, Key=prefix + file_name, Bucket=bucket_name, Body=write_shard(df, file_format))
+        shard_index.indexes.pop((bucket_name, prefix + file_name), None)
+        if shard_cache.cache is not None:
+            shard_cache.cache.invalidate(bucket_name, prefix + file_name)
         return {"success": True, "row_count": len(df), "skip": False}
     except Exception as e:
         print(e)
-        {"success": False, "msg": e}
+        return {"success": False, "msg": e}
 
+# Single file changes, several files are better collected in one MetadataWriter
 async def update_meta_data(file_name,  row_count, media, collection):
-    mongo_collection = MongoClient['scraping'][collection]
-    try:
-        mongo_collection.update_one({"file_name": file_name, "source_name": media}, { "$set": { "row_count": row_count } })
-        return {"success": True }
-    except Exception as e:
-        print(e)
-        {"success": False, "msg": e}
+    writer = MetadataWriter(media, collection)
+    writer.update(file_name, row_count)
+    return (await writer.flush())[file_name]
 
 async def remove_csv(file_name: str, bucket_name: str, prefix):
     # get file from s3
     try:
-        obj = s3_client.delete_object(Bucket=bucket_name, Key=prefix + file_name)
+        obj = await run_in_thread(s3_client.delete_object, Bucket=bucket_name, Key=prefix + file_name)
+        await run_in_thread(shard_index.remove_index, s3_client, bucket_name, prefix + file_name)
+        if shard_cache.cache is not None:
+            await run_in_thread(shard_cache.cache.invalidate, bucket_name, prefix + file_name)
         return {"success": True }
     except Exception as e:
         print(e)
-        {"success": False, "msg": e}
+        return {"success": False, "msg": e}
 
 async def delete_meta_data(file_name, media, collection):
-    mongo_collection = MongoClient['scraping'][collection]
-    try:
-        mongo_collection.delete_one({"file_name": file_name, "source_name": media})
-        return {"success": True }
-    except Exception as e:
-        print(e)
-        {"success": False, "msg": e}
\ No newline at end of file
+    writer = MetadataWriter(media, collection)
+    writer.delete(file_name)
+    return (await writer.flush())[file_name]
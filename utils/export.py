@@ -0,0 +1,343 @@
+import os
+import zlib
+import uuid
+import asyncio
+import datetime
+
+from server.database import MongoClient, SessionLocal
+from utils import data_access, serialization, api_key_utils, log_utils
+from utils.shard_reader import project_columns
+from utils.url_index import url_hash
+from utils.multithread import run_in_thread
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Export jobs write every row of a query to one compressed file in the bucket of the media. The
+# rows are read window by window through the page map and shard by shard like the NDJSON pages, so
+# a job holds one encoded part instead of the whole export, and the file is sent as a multipart
+# upload. The API key is charged one use per EXPORT_ROWS_PER_CHARGE exported rows.
+JOBS_COLLECTION = "export_jobs"
+COLLECTION_NAME = "scraping"
+EXPORT_PREFIX = "exports/"
+FORMATS = ["csv", "ndjson", "parquet"]
+COMPRESSIONS = ["none", "gzip", "zstd"]
+# Rows resolved through the page map at a time
+WINDOW_ROWS = int(os.environ.get('export_window_rows', 50000))
+ROWS_PER_CHARGE = int(os.environ.get('export_rows_per_charge', 1000))
+# S3 parts are at least 5 MB except the last one
+PART_SIZE = max(int(float(os.environ.get('export_part_size_mb', 8)) * 1024 * 1024), 5 * 1024 * 1024)
+# Jobs running at the same time on this server, the others wait as queued
+MAX_JOBS = int(os.environ.get('export_max_jobs', 2))
+# Seconds a download link of a finished export is valid
+URL_TTL = int(os.environ.get('export_url_ttl', 3600))
+# Jobs run as tasks of the server that created them, which refreshes their updated_at every
+# HEARTBEAT_SECONDS. Queued or running jobs not refreshed for STALE_SECONDS belong to a server that
+# stopped: they are marked as failed and their charges are given back.
+HEARTBEAT_SECONDS = float(os.environ.get('export_heartbeat_seconds', 30))
+STALE_SECONDS = float(os.environ.get('export_stale_seconds', 4 * HEARTBEAT_SECONDS))
+
+CONTENT_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+# Running jobs, referenced until they are done
+running = set()
+# Ids of the queued and running jobs of this server
+owned = set()
+slots = None
+
+def get_jobs_collection():
+    return MongoClient['scraping'][JOBS_COLLECTION]
+
+def validate_options(file_format: str, compression: str):
+    if file_format not in FORMATS:
+        raise Exception("Invalid input of format, please choose from " + ", ".join(FORMATS) + ".")
+    if compression not in COMPRESSIONS:
+        raise Exception("Invalid input of compression, please choose from " + ", ".join(COMPRESSIONS) + ".")
+    if compression == "zstd" and file_format != "parquet" and zstandard is None:
+        raise Exception("zstd compression is not available on this server, please choose gzip.")
+
+# Parquet files compress their columns themselves, the other formats are compressed as a whole
+def artifact_key(job_id: str, file_format: str, compression: str):
+    extension = {"none": "", "gzip": ".gz", "zstd": ".zst"}[compression]
+    return EXPORT_PREFIX + job_id + "." + file_format + ("" if file_format == "parquet" else extension)
+
+class Compressor:
+    def __init__(self, compression: str):
+        if compression == "gzip":
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif compression == "zstd":
+            self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            self.compressor = None
+
+    def compress(self, data: bytes):
+        return data if self.compressor is None else self.compressor.compress(data)
+
+    def flush(self):
+        return b"" if self.compressor is None else self.compressor.flush()
+
+# File-like sink of the parquet writer whose written bytes are taken part by part. It keeps
+# counting positions so the offsets in the footer stay right.
+class ChunkSink:
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+# Encodes frames of rows into consecutive bytes of the export file
+class Encoder:
+    def __init__(self, file_format: str, compression: str, model):
+        self.file_format = file_format
+        self.model = model
+        # Columns of the first part, the csv header is written with it
+        self.columns = None
+        if file_format == "parquet":
+            self.compressor = Compressor("none")
+            self.codec = compression
+            self.sink = ChunkSink()
+            self.writer = None
+        else:
+            self.compressor = Compressor(compression)
+
+    def encode(self, df):
+        frame = serialization.prepare_frame(df, self.model)
+        # Every part has the columns of the first one, shards may lack optional columns
+        first = self.columns is None
+        if first:
+            self.columns = list(frame.columns)
+        else:
+            frame = frame.reindex(columns=self.columns)
+        if self.file_format == "csv":
+            data = frame.to_csv(index=False, header=first).encode("utf-8")
+        elif self.file_format == "ndjson":
+            data = serialization.encode_lines(frame, self.model) if len(frame.index) > 0 else b""
+        else:
+            data = self.encode_parquet(frame)
+        return self.compressor.compress(data)
+
+    def encode_parquet(self, frame):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.writer is None:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            self.writer = pq.ParquetWriter(pa.PythonFile(self.sink, mode="w"), table.schema, compression=self.codec)
+        else:
+            table = pa.Table.from_pandas(frame, schema=self.writer.schema, preserve_index=False)
+        self.writer.write_table(table)
+        return self.sink.take()
+
+    def close(self):
+        data = b""
+        if self.file_format == "parquet" and self.writer is not None:
+            self.writer.close()
+            data = self.sink.take()
+        return self.compressor.compress(data) + self.compressor.flush()
+
+# Multipart upload of the export file, bytes are sent in parts of PART_SIZE
+class MultipartUpload:
+    def __init__(self, bucket_name: str, key: str, content_type: str):
+        self.bucket_name = bucket_name
+        self.key = key
+        self.content_type = content_type
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.size = 0
+
+    async def write(self, data: bytes):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= PART_SIZE:
+            await self.send_part()
+
+    async def send_part(self):
+        if self.upload_id is None:
+            response = await run_in_thread(data_access.s3_client.create_multipart_upload, Bucket=self.bucket_name, Key=self.key, ContentType=self.content_type)
+            self.upload_id = response["UploadId"]
+        part_number = len(self.parts) + 1
+        body = bytes(self.buffer)
+        self.buffer = bytearray()
+        response = await run_in_thread(data_access.s3_client.upload_part, Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=body)
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    async def complete(self):
+        # Files smaller than a part are sent in one request
+        if self.upload_id is None:
+            await run_in_thread(data_access.s3_client.put_object, Bucket=self.bucket_name, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+            return
+        if len(self.buffer) > 0:
+            await self.send_part()
+        await run_in_thread(data_access.s3_client.complete_multipart_upload, Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": self.parts})
+
+    # Parts already sent are not kept by the bucket
+    async def abort(self):
+        if self.upload_id is not None:
+            try:
+                await run_in_thread(data_access.s3_client.abort_multipart_upload, Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                print("Failed to abort multipart upload of " + self.key + ": " + str(e))
+
+# Charges the API key one use per ROWS_PER_CHARGE rows, started batches included
+class ChargeMeter:
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.rows = 0
+        self.charges = 0
+
+    async def add(self, rows: int, final: bool = False):
+        total = self.rows + rows
+        batches = -(-total // ROWS_PER_CHARGE) if final else total // ROWS_PER_CHARGE
+        if batches > self.charges:
+            db = SessionLocal()
+            try:
+                response = await api_key_utils.consume_key(db, self.api_key, batches - self.charges)
+            finally:
+                db.close()
+            if not response.get("success"):
+                raise Exception("Export stopped after " + str(self.rows) + " rows: " + str(response.get("error")))
+            self.charges = batches
+        self.rows = total
+
+# Frames of the rows of the query without repeated urls, with the index column of the pages
+async def iterate_rows(media: str, query: dict, columns: list = None):
+    seen_urls = set()
+    next_index = 1
+    lower_bound = 1
+    while True:
+        upper_bound = lower_bound + WINDOW_ROWS - 1
+        last_record, file_names, shards = await data_access.get_files_name(query["sortKey"], query["searchKey"], query["sortDirection"], lower_bound, upper_bound, media, COLLECTION_NAME, query["filters"])
+        if len(file_names) == 0:
+            break
+        async for df in data_access.iterate_csv_records(last_record, lower_bound, upper_bound, media + 'scrapingbucket', file_names, media + "/", shards, columns):
+            hashes = df["url"].map(url_hash)
+            duplicated = hashes.duplicated(keep='first') | hashes.isin(seen_urls)
+            df = df.loc[~duplicated.to_numpy()].copy(deep=False)
+            seen_urls.update(hashes[~duplicated])
+            if len(df.index) == 0:
+                continue
+            df = project_columns(df, query["fields"])
+            df = await data_access.add_index_column(df, next_index)
+            next_index += len(df.index)
+            yield df
+        lower_bound = upper_bound + 1
+
+# A job failed as orphaned is not changed anymore, its charges were given back
+async def update_job(job_id: str, fields: dict):
+    fields["updated_at"] = datetime.datetime.utcnow()
+    await get_jobs_collection().update_one({"_id": job_id, "refunded": {"$exists": False}}, {"$set": fields})
+
+# Store the job and start it in the background, returns the job id
+async def create_job(api_key: str, media: str, query: dict, file_format: str, compression: str, model):
+    global slots
+    validate_options(file_format, compression)
+    job_id = uuid.uuid4().hex
+    now = datetime.datetime.utcnow()
+    await get_jobs_collection().insert_one({
+        "_id": job_id, "api_key": api_key, "media": media, "query": query, "format": file_format, "compression": compression,
+        "status": "queued", "rows": 0, "charges": 0, "created_at": now, "updated_at": now,
+    })
+    if slots is None:
+        slots = asyncio.Semaphore(MAX_JOBS)
+    owned.add(job_id)
+    task = asyncio.ensure_future(run_job(job_id, api_key, media, query, file_format, compression, model))
+    running.add(task)
+    task.add_done_callback(running.discard)
+    task.add_done_callback(lambda _: owned.discard(job_id))
+    return job_id
+
+async def run_job(job_id: str, api_key: str, media: str, query: dict, file_format: str, compression: str, model):
+    async with slots:
+        key = artifact_key(job_id, file_format, compression)
+        upload = MultipartUpload(media + 'scrapingbucket', key, CONTENT_TYPES[file_format])
+        meter = ChargeMeter(api_key)
+        try:
+            await update_job(job_id, {"status": "running"})
+            encoder = Encoder(file_format, compression, model)
+            # Only the requested columns are parsed, url is always needed to find duplicates
+            columns = None if query["fields"] is None else list(dict.fromkeys(query["fields"] + ["url"]))
+            async for df in iterate_rows(media, query, columns):
+                # Rows are paid for before they are written
+                await meter.add(len(df.index))
+                await upload.write(await run_in_thread(encoder.encode, df))
+                await update_job(job_id, {"rows": meter.rows, "charges": meter.charges, "upload_id": upload.upload_id})
+            await meter.add(0, final=True)
+            await upload.write(await run_in_thread(encoder.close))
+            await upload.complete()
+            await update_job(job_id, {"status": "completed", "rows": meter.rows, "charges": meter.charges, "key": key, "size": upload.size})
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to export with error: " + str(e) + ". Job: " + job_id + "\n", "error_log.txt")
+            await upload.abort()
+            await update_job(job_id, {"status": "failed", "rows": meter.rows, "charges": meter.charges, "error": str(e)})
+
+# Give the charges of a job back to its API key
+async def refund_job(job: dict):
+    if not job.get("charges"):
+        return
+    db = SessionLocal()
+    try:
+        await api_key_utils.refund_key(db, job["api_key"], job["charges"])
+    finally:
+        db.close()
+
+# Fail the queued and running jobs of servers that stopped and refund them. The status is changed
+# by one conditional update, so that a job is refunded by one server only.
+async def fail_orphaned_jobs():
+    jobs_collection = get_jobs_collection()
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=STALE_SECONDS)
+    condition = {"status": {"$in": ["queued", "running"]}, "updated_at": {"$lt": cutoff}}
+    orphans = [job async for job in jobs_collection.find(condition, {"api_key": 1, "charges": 1, "media": 1, "format": 1, "compression": 1, "upload_id": 1}) if job["_id"] not in owned]
+    for job in orphans:
+        result = await jobs_collection.update_one(dict(condition, _id=job["_id"]), {"$set": {"status": "failed", "error": "The server running the export stopped.", "refunded": job.get("charges", 0), "updated_at": datetime.datetime.utcnow()}})
+        if result.modified_count == 0:
+            continue
+        try:
+            await refund_job(job)
+            if job.get("upload_id") is not None:
+                await run_in_thread(data_access.s3_client.abort_multipart_upload, Bucket=job["media"] + 'scrapingbucket', Key=artifact_key(job["_id"], job["format"], job["compression"]), UploadId=job["upload_id"])
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to clean up orphaned export with error: " + str(e) + ". Job: " + job["_id"] + "\n", "error_log.txt")
+        print("Failed orphaned export " + job["_id"] + ", refunded " + str(job.get("charges", 0)) + " charges")
+
+# Refresh the jobs of this server and fail the orphaned ones, from startup on
+async def watch_jobs():
+    while True:
+        try:
+            if len(owned) > 0:
+                await get_jobs_collection().update_many({"_id": {"$in": list(owned)}}, {"$set": {"updated_at": datetime.datetime.utcnow()}})
+            await fail_orphaned_jobs()
+        except Exception as e:
+            print("Failed to check export jobs: " + str(e))
+        await asyncio.sleep(HEARTBEAT_SECONDS)
+
+# Job of the API key, with a download link once completed, None if there is no such job
+async def get_job(job_id: str, api_key: str):
+    job = await get_jobs_collection().find_one({"_id": job_id, "api_key": api_key}, {"api_key": 0})
+    if job is None:
+        return None
+    job["job_id"] = job.pop("_id")
+    if job["status"] == "completed":
+        job["url"] = await run_in_thread(data_access.s3_client.generate_presigned_url, "get_object", Params={"Bucket": job["media"] + 'scrapingbucket', "Key": job["key"]}, ExpiresIn=URL_TTL)
+    return job
@@ -0,0 +1,81 @@
+import os
+import random
+import asyncio
+
+from pymongo import UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+
+from server.database import MongoClient
+from utils import page_map, response_cache
+
+# Metadata changes of many shards sent to MongoDB in one unordered bulk_write. Operations that
+# fail are retried with jittered exponential backoff, and every file gets its own outcome.
+MAX_ATTEMPTS = int(os.environ.get('metadata_write_attempts', 5))
+BASE_DELAY = float(os.environ.get('metadata_write_base_delay', 0.2))
+
+class MetadataWriter:
+    def __init__(self, media: str, collection: str, max_attempts: int = MAX_ATTEMPTS, base_delay: float = BASE_DELAY):
+        self.media = media
+        self.collection = collection
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        # file_name -> (kind, pymongo operation, row_count), the last change of a file wins
+        self.pending = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    # The shard was rewritten, rows it skipped as duplicates of earlier shards are no longer known
+    def update(self, file_name: str, row_count: int):
+        operation = UpdateOne({"file_name": file_name, "source_name": self.media}, {"$set": {"row_count": row_count}, "$unset": {"unique_row_count": "", "duplicate_rows": ""}})
+        self.pending[file_name] = ("update", operation, row_count)
+
+    # Other fields of a shard that did not change its rows
+    def set_fields(self, file_name: str, fields: dict):
+        operation = UpdateOne({"file_name": file_name, "source_name": self.media}, {"$set": fields})
+        self.pending[file_name] = ("set", operation, fields.get("row_count"))
+
+    def delete(self, file_name: str):
+        operation = DeleteOne({"file_name": file_name, "source_name": self.media})
+        self.pending[file_name] = ("delete", operation, None)
+
+    # Send the pending changes, returns {file_name: {"success": bool, "msg": error}}
+    async def flush(self):
+        mongo_collection = MongoClient['scraping'][self.collection]
+        pending = self.pending
+        self.pending = {}
+        results = {}
+        for attempt in range(self.max_attempts):
+            if len(pending) == 0:
+                break
+            if attempt > 0:
+                await asyncio.sleep(random.uniform(0, self.base_delay * 2 ** attempt))
+            file_names = list(pending)
+            failed = {}
+            try:
+                await mongo_collection.bulk_write([pending[file_name][1] for file_name in file_names], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    failed[file_names[error["index"]]] = error.get("errmsg", str(error))
+            except Exception as e:
+                failed = {file_name: str(e) for file_name in file_names}
+            for file_name in file_names:
+                if file_name in failed:
+                    results[file_name] = {"success": False, "msg": failed[file_name]}
+                else:
+                    results[file_name] = {"success": True}
+                    self.apply(file_name, *pending[file_name])
+            pending = {file_name: pending[file_name] for file_name in failed}
+            if len(failed) > 0:
+                print("Failed to write metadata of " + str(len(failed)) + " files, attempt " + str(attempt + 1) + " of " + str(self.max_attempts))
+        return results
+
+    # Keep the cached page maps and pages of this server in line with the written metadata
+    def apply(self, file_name, kind, operation, row_count):
+        response_cache.bump(self.media)
+        if kind == "update":
+            page_map.update_row_count(self.media, file_name, row_count)
+        elif kind == "delete":
+            page_map.remove_file(self.media, file_name)
+        else:
+            page_map.invalidate(self.media)
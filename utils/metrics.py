@@ -0,0 +1,157 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+from utils import request_timing
+
+# Counters and histograms of the request path, exposed in the Prometheus text format by
+# GET /metrics. Metrics are kept per label values, an observation takes a lock and a bisect.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 8, 13, 21)
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    pairs = [(name, value) for name, value in zip(names, values)] + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join(name + '="' + escape(value) + '"' for name, value in pairs) + "}"
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        # label values -> child
+        self.children = {}
+        registry.append(self)
+
+    def labels(self, *values, **labels):
+        if labels:
+            values = tuple(labels[name] for name in self.labelnames)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    def expose(self):
+        lines = ["# HELP " + self.name + " " + self.documentation, "# TYPE " + self.name + " " + self.kind]
+        for values, child in list(self.children.items()):
+            lines.extend(self.expose_child(values, child))
+        return lines
+
+class CounterChild:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Counter(Metric):
+    kind = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def expose_child(self, values, child):
+        return [self.name + format_labels(self.labelnames, values) + " " + format_value(child.value)]
+
+class HistogramChild:
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        # Observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def expose_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(self.name + "_bucket" + format_labels(self.labelnames, values, [("le", format_value(bound))]) + " " + str(cumulative))
+        lines.append(self.name + "_sum" + format_labels(self.labelnames, values) + " " + repr(total))
+        lines.append(self.name + "_count" + format_labels(self.labelnames, values) + " " + str(cumulative))
+        return lines
+
+registry = []
+
+def expose() -> str:
+    lines = []
+    for metric in registry:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+FUNCTION_SECONDS = Histogram("scraping_function_duration_seconds", "Duration of the functions decorated with utils.timer.timing.", ["function"])
+STAGE_SECONDS = Histogram("scraping_stage_duration_seconds", "Duration of a stage of the data path: metadata_scan, shard_download, parse, dedup, serialization, api_key_consume.", ["stage", "media"])
+DEDUP_ITERATIONS = Histogram("scraping_dedup_iterations", "Windows read by a page until it has no duplicate urls left.", ["media"], ITERATION_BUCKETS)
+BYTES_FETCHED = Counter("scraping_s3_bytes_fetched_total", "Bytes of shards and indexes downloaded from the bucket.", ["media"])
+ROWS_FETCHED = Counter("scraping_rows_fetched_total", "Rows parsed from downloaded shards.", ["media"])
+ROWS_SERVED = Counter("scraping_rows_served_total", "Rows returned in data pages.", ["media"])
+
+# with stage_timer("parse", media): ... also adds the duration to the Server-Timing of the request
+@contextmanager
+def stage_timer(stage: str, media: str = ""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage, media or "").observe(duration)
+        request_timing.add_stage(stage, duration)
+
+def add_bytes_fetched(media: str, size: int):
+    BYTES_FETCHED.labels(media or "").inc(size)
+    request_timing.add("bytes_fetched", size)
+
+def observe_dedup_iterations(media: str, iterations: int):
+    DEDUP_ITERATIONS.labels(media).observe(iterations)
+    request_timing.add("dedup_iterations", iterations)
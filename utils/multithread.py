@@ -1,10 +1,35 @@
+import os
+import asyncio
+import functools
+import contextvars
 from concurrent.futures import ThreadPoolExecutor
 
+from utils import profiling
 
-def parallel_multithreading(method, array):
+# Threads shared by every request for blocking boto3 calls and csv parsing
+MAX_WORKERS = int(os.environ.get('s3_max_workers', 16))
+# Shards downloaded at the same time by a single request
+REQUEST_CONCURRENCY = int(os.environ.get('s3_request_concurrency', 4))
 
-    with ThreadPoolExecutor(max_workers=3) as executor:
-        #future_to_key = {executor.submit(download_object, repeat(s3_client), key): key for key in file_names}
-        results = executor.map(method, array)
-        for result in results:
-            yield result
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="s3")
+
+# Run a blocking method in the shared executor without blocking the event loop, in a copy of the
+# context of the caller so the thread records into the timing of its request
+async def run_in_thread(method, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    # Requests profiled by an admin, see utils/profiling.py
+    if profiling.current.get() is not None:
+        method = functools.partial(profiling.profile_thread, method)
+    return await loop.run_in_executor(executor, functools.partial(context.run, method, *args, **kwargs))
+
+# Run method on every item of the array in the shared executor, at most `limit` at a time.
+# Results keep the order of the array.
+async def parallel_async(method, array, limit=REQUEST_CONCURRENCY):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item):
+        async with semaphore:
+            return await run_in_thread(method, item)
+
+    return await asyncio.gather(*[run(item) for item in array])
@@ -0,0 +1,225 @@
+import os
+import time
+import bisect
+import asyncio
+from collections import OrderedDict
+
+# Seconds before a page map is rebuilt from Mongo, so shards added by the scrapers become visible.
+# Without response_cache_watch this is how long a new shard can be missing from the pages.
+PAGE_MAP_TTL = float(os.environ.get('page_map_ttl', 300))
+# Same for the unfiltered latest first query, where the new shards of the scrapers land on the first page
+PAGE_MAP_LATEST_TTL = float(os.environ.get('page_map_latest_ttl', 30))
+# Page maps kept in memory, filtered queries add one per filter value
+MAX_PAGE_MAPS = int(os.environ.get('page_map_max_entries', 256))
+
+# Cumulative row offsets of the csv files of one sorted metadata query, stored in a Fenwick tree
+# so that both "which file holds row n" and "row count of file changed" cost O(log n)
+class PageMap:
+    # documents are (file_name, row_count) or (file_name, row_count, attributes) in sorted order,
+    # attributes being a dict of other metadata of the file such as its file_format. Files whose
+    # attributes have "pending" are counted with an upper bound of their rows until settle() gives
+    # their matching rows, see utils/shard_stats.py.
+    def __init__(self, documents, ttl=PAGE_MAP_TTL):
+        self.file_names = []
+        self.row_counts = []
+        self.positions = {}
+        self.attributes = {}
+        # Sorted positions of the pending files
+        self.pending = []
+        # Held while pending files are settled
+        self.settle_lock = asyncio.Lock()
+        for document in documents:
+            file_name, row_count = document[0], int(document[1])
+            if len(document) > 2 and document[2]:
+                self.attributes[file_name] = document[2]
+                if document[2].get("pending"):
+                    self.pending.append(len(self.file_names))
+            self.positions[file_name] = len(self.file_names)
+            self.file_names.append(file_name)
+            self.row_counts.append(max(row_count, 0))
+
+        # Build the tree in O(n)
+        size = len(self.file_names)
+        self.tree = [0] + self.row_counts[:]
+        for i in range(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                self.tree[parent] += self.tree[i]
+        self.ttl = ttl
+        self.built_at = time.time()
+
+    def get_attributes(self, file_name):
+        return self.attributes.get(file_name, {})
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def is_expired(self):
+        return time.time() - self.built_at > self.ttl
+
+    # Number of rows in the first `count` files
+    def prefix(self, count):
+        total = 0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def total(self):
+        return self.prefix(len(self.file_names))
+
+    # Position of the file containing the given 1-based row number, len(self) if beyond the last row
+    def search(self, row):
+        size = len(self.file_names)
+        position = 0
+        remaining = row
+        step = 1 << size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= size and self.tree[next_position] < remaining:
+                position = next_position
+                remaining -= self.tree[next_position]
+            step >>= 1
+        return position
+
+    # Returns the last row number of the last file selected, and the files covering [lower_bound, upper_bound]
+    def resolve(self, lower_bound, upper_bound):
+        position = self.search(lower_bound)
+        if position >= len(self.file_names):
+            return self.total(), []
+        last_row_number_of_file = self.prefix(position)
+        file_names = []
+        while position < len(self.file_names) and last_row_number_of_file + 1 <= upper_bound:
+            row_count = self.row_counts[position]
+            if row_count > 0:
+                file_names.append(self.file_names[position])
+                last_row_number_of_file += row_count
+            position += 1
+        return last_row_number_of_file, file_names
+
+    # File name and 0-based row offset inside it of a 1-based row number, (None, 0) if beyond the last row
+    def locate(self, row):
+        position = self.search(row)
+        if position >= len(self.file_names):
+            return None, 0
+        return self.file_names[position], row - self.prefix(position) - 1
+
+    # 1-based row number of a row offset inside a file, None if the file is not in this query
+    def row_number(self, file_name, offset):
+        position = self.positions.get(file_name)
+        if position is None:
+            return None
+        return self.prefix(position) + min(offset, self.row_counts[position]) + 1
+
+    def update(self, file_name, row_count, attributes=None):
+        position = self.positions.get(file_name)
+        if position is None:
+            return
+        if attributes is not None:
+            self.attributes[file_name] = attributes
+        row_count = max(int(row_count), 0)
+        delta = row_count - self.row_counts[position]
+        self.row_counts[position] = row_count
+        index = position + 1
+        while index <= len(self.file_names) and delta != 0:
+            self.tree[index] += delta
+            index += index & -index
+
+    # Pending files at positions up to `position`
+    def pending_until(self, position):
+        return [self.file_names[pending] for pending in self.pending[:bisect.bisect_right(self.pending, position)]]
+
+    # Row count of a pending file is now the number of its matching rows
+    def settle(self, file_name, rows):
+        position = self.positions[file_name]
+        index = bisect.bisect_left(self.pending, position)
+        if index < len(self.pending) and self.pending[index] == position:
+            del self.pending[index]
+        attributes = dict(self.get_attributes(file_name), rows=rows)
+        attributes.pop("pending", None)
+        self.update(file_name, len(rows), attributes)
+
+    # Deleted files keep their slot with zero rows so that positions stay valid
+    def remove(self, file_name):
+        if file_name not in self.positions:
+            return
+        position = self.positions[file_name]
+        if position in self.pending:
+            self.pending.remove(position)
+        self.update(file_name, 0, {})
+
+
+# One page map per (source_name, sortKey, sortDirection, searchKey) and row filters if any, least
+# recently used first
+page_maps = OrderedDict()
+# key -> [lock, number of requests using it], only for the page maps being built
+build_locks = {}
+
+def page_map_key(source_name, sortKey, sortDirection, searchKey, filters=None):
+    if not filters:
+        return (source_name, sortKey, sortDirection, searchKey)
+    return (source_name, sortKey, sortDirection, searchKey, tuple(sorted(filters.items())))
+
+# Row counts of a filtered page map are counts of matching rows, which a rewrite changes unknowingly
+def is_filtered(key):
+    return len(key) > 4
+
+# Unfiltered query without sortKey and searchKey, sorted by created_at newest first
+def is_latest(key):
+    return not is_filtered(key) and key[1] is None and key[3] is None
+
+def get_ttl(key):
+    return PAGE_MAP_LATEST_TTL if is_latest(key) else PAGE_MAP_TTL
+
+# Drop the expired page maps, then the least recently used ones over MAX_PAGE_MAPS
+def sweep():
+    for key in [key for key, page_map in page_maps.items() if page_map.is_expired()]:
+        del page_maps[key]
+    while len(page_maps) > MAX_PAGE_MAPS:
+        page_maps.popitem(last=False)
+
+# Return the cached page map of a query, building it with `loader` on first use or when expired.
+# `loader` is a coroutine function returning the documents of PageMap in sorted order.
+async def get_page_map(key, loader):
+    page_map = page_maps.get(key)
+    if page_map is not None and not page_map.is_expired():
+        page_maps.move_to_end(key)
+        return page_map
+    entry = build_locks.setdefault(key, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            page_map = page_maps.get(key)
+            if page_map is None or page_map.is_expired():
+                page_map = PageMap(await loader(), get_ttl(key))
+                page_maps[key] = page_map
+                page_maps.move_to_end(key)
+                sweep()
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del build_locks[key]
+    return page_map
+
+# The file was rewritten, rows it skipped as duplicates of earlier files are no longer known
+def update_row_count(source_name, file_name, row_count):
+    for key, page_map in list(page_maps.items()):
+        if key[0] != source_name:
+            continue
+        if is_filtered(key):
+            del page_maps[key]
+            continue
+        attributes = dict(page_map.get_attributes(file_name))
+        attributes.pop("duplicate_rows", None)
+        attributes["file_row_count"] = row_count
+        page_map.update(file_name, row_count, attributes)
+
+def remove_file(source_name, file_name):
+    for key, page_map in page_maps.items():
+        if key[0] == source_name:
+            page_map.remove(file_name)
+
+def invalidate(source_name=None):
+    for key in list(page_maps.keys()):
+        if source_name is None or key[0] == source_name:
+            del page_maps[key]
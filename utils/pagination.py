@@ -0,0 +1,27 @@
+import json
+import base64
+
+# Continuation token of a data query. It records where the next page starts as the csv file and
+# the row offset inside it, the index of the next row served (dedup watermark), the absolute row
+# number as a fallback when the file no longer exists, and the query it belongs to.
+
+def query_fingerprint(media, sortKey, searchKey, sortDirection, filters=None):
+    if not filters:
+        return [media, sortKey, searchKey, sortDirection]
+    return [media, sortKey, searchKey, sortDirection, sorted([name, value] for name, value in filters.items())]
+
+def encode_cursor(file_name: str, offset: int, watermark: int, row: int, query: list):
+    payload = {"f": file_name, "o": offset, "w": watermark, "r": row, "q": query}
+    token = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode())
+    return token.decode().rstrip("=")
+
+def decode_cursor(token: str, query: list):
+    try:
+        padding = "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(token + padding))
+        file_name, offset, watermark, row = payload["f"], int(payload["o"]), int(payload["w"]), int(payload["r"])
+    except Exception:
+        raise Exception("Invalid cursor, please use the next_cursor returned by the previous page.")
+    if payload.get("q") != query:
+        raise Exception("Invalid cursor, it belongs to a query with different media, sortKey, searchKey, sortDirection or filters.")
+    return file_name, offset, watermark, row
@@ -0,0 +1,63 @@
+import os
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import shard_cache
+
+# Opt-in warming of the shard cache with the shards of the page following the one just served.
+# Prefetches run in their own small thread pool, so they never take a thread from requests, and
+# are dropped instead of queued when too many are pending.
+ENABLED = os.environ.get('prefetch_enabled', 'false').lower() in ('1', 'true', 'yes') and shard_cache.cache is not None
+WORKERS = int(os.environ.get('prefetch_workers', 2))
+MAX_PENDING = int(os.environ.get('prefetch_max_pending', 8))
+
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="prefetch")
+lock = threading.Lock()
+# Running prefetch tasks, referenced until they are done
+pending = set()
+# (bucket_name, key) of prefetched shards not yet read by a request -> source name
+prefetched = {}
+# source name -> counters
+stats = {}
+
+def get_source_stats(source_name: str):
+    return stats.setdefault(source_name, {"scheduled": 0, "dropped": 0, "prefetched": 0, "already_cached": 0, "hits": 0, "errors": 0})
+
+# Run method(*args) in the background if prefetching is enabled and not saturated
+def schedule(source_name: str, method, *args):
+    if not ENABLED:
+        return
+    source_stats = get_source_stats(source_name)
+    if len(pending) >= MAX_PENDING:
+        source_stats["dropped"] += 1
+        return
+    source_stats["scheduled"] += 1
+    task = asyncio.ensure_future(method(*args))
+    pending.add(task)
+    task.add_done_callback(pending.discard)
+
+async def run_in_prefetch_thread(method, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(method, *args, **kwargs))
+
+def mark_prefetched(source_name: str, bucket_name: str, key: str):
+    with lock:
+        prefetched[(bucket_name, key)] = source_name
+        get_source_stats(source_name)["prefetched"] += 1
+
+# A request read a shard from the cache, count it if it was there thanks to a prefetch
+def record_read(bucket_name: str, key: str):
+    if not ENABLED:
+        return
+    with lock:
+        source_name = prefetched.pop((bucket_name, key), None)
+        if source_name is not None:
+            get_source_stats(source_name)["hits"] += 1
+
+def get_stats():
+    result = {}
+    for source_name, source_stats in stats.items():
+        result[source_name] = dict(source_stats, hit_ratio=source_stats["hits"] / source_stats["prefetched"] if source_stats["prefetched"] > 0 else 0.0)
+    return result
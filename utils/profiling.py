@@ -0,0 +1,179 @@
+import os
+import io
+import json
+import time
+import uuid
+import pstats
+import asyncio
+import cProfile
+import threading
+import contextvars
+
+# Profiles of single requests, asked for by admin users with an X-Profile header next to their
+# "Authorization: Bearer <jwt>". The event loop thread and the worker threads of the request run
+# under cProfile, and the merged stats are stored in PROFILE_DIRECTORY as <request_id>.prof (pstats
+# format, e.g. python -m pstats or snakeviz) with a <request_id>.json summary. Requests without
+# the header, or of users who are not admins, go straight to the app. One request is profiled at a time, requests served by the
+# event loop meanwhile are part of its profile.
+PROFILE_DIRECTORY = os.environ.get('profile_directory', 'profiles')
+# Profiles kept on disk, the oldest are deleted first
+PROFILES_KEPT = int(os.environ.get('profile_keep', 50))
+HEADER = b"x-profile"
+# Functions whose time is summarised in the json file of a profile, the last ones are the pydantic
+# serialization of FastAPI responses
+SUMMARY_FUNCTIONS = ["get_files_name", "get_csv_record", "iterate_csv_records", "duplicate_check", "download_shard", "read_shard", "encode_response", "encode_lines", "serialize_response", "jsonable_encoder"]
+
+current = contextvars.ContextVar("profile", default=None)
+lock = asyncio.Lock()
+
+class ProfileSession:
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        # Profiles of the worker threads, merged into the profile of the event loop thread
+        self.thread_profiles = []
+
+    def stats(self):
+        stats = pstats.Stats(self.profile)
+        for profile in self.thread_profiles:
+            try:
+                stats.add(profile)
+            except TypeError:
+                # Nothing was recorded in the thread
+                pass
+        return stats
+
+# Run method in a worker thread under its own profiler, see utils.multithread.run_in_thread. From
+# Python 3.12 cProfile allows one active profiler, which already records every thread: the thread
+# then runs without one.
+def profile_thread(method, *args, **kwargs):
+    session = current.get()
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        return method(*args, **kwargs)
+    try:
+        return method(*args, **kwargs)
+    finally:
+        profile.disable()
+        with session.lock:
+            session.thread_profiles.append(profile)
+
+# Cumulative seconds and calls of SUMMARY_FUNCTIONS
+def summarize(stats: pstats.Stats):
+    summary = {}
+    for (_, _, function_name), (_, calls, _, cumulative, _) in stats.stats.items():
+        if function_name in SUMMARY_FUNCTIONS:
+            entry = summary.setdefault(function_name, {"calls": 0, "cumulative_seconds": 0.0})
+            entry["calls"] += calls
+            entry["cumulative_seconds"] += cumulative
+    return summary
+
+def profile_path(request_id: str, extension: str):
+    return os.path.join(PROFILE_DIRECTORY, request_id + extension)
+
+def save_profile(request_id: str, session: ProfileSession, info: dict):
+    os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+    stats = session.stats()
+    stats.dump_stats(profile_path(request_id, ".prof"))
+    info = dict(info, request_id=request_id, functions=summarize(stats))
+    with open(profile_path(request_id, ".json"), "w") as file:
+        json.dump(info, file)
+    for old in list_profiles()[PROFILES_KEPT:]:
+        delete_profile(old["request_id"])
+
+def delete_profile(request_id: str):
+    for extension in (".prof", ".json"):
+        try:
+            os.remove(profile_path(request_id, extension))
+        except OSError:
+            pass
+
+# Summaries of the stored profiles, newest first
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIRECTORY):
+        return []
+    profiles = []
+    for name in os.listdir(PROFILE_DIRECTORY):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIRECTORY, name)) as file:
+                profiles.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+    return sorted(profiles, key=lambda profile: profile.get("created_at", 0), reverse=True)
+
+# Path of the pstats file of a profile, None if there is none. request_id is a uuid hex.
+def get_profile_path(request_id: str):
+    if len(request_id) != 32 or any(character not in "0123456789abcdef" for character in request_id):
+        return None
+    path = profile_path(request_id, ".prof")
+    return path if os.path.isfile(path) else None
+
+# The functions taking most cumulative time, as printed by pstats
+def profile_text(path: str, limit: int = 50):
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output)
+    stats.sort_stats("cumulative").print_stats(limit)
+    return output.getvalue()
+
+# User of a bearer token if the user is an admin
+def get_admin(authorization: str):
+    from jose import jwt, JWTError
+    from server.database import SessionLocal
+    from server.models import Users
+    from utils.auth import SECRET_KEY, ALGORITHM
+    if not authorization.startswith("Bearer "):
+        return None
+    try:
+        payload = jwt.decode(authorization[len("Bearer "):], SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    db = SessionLocal()
+    try:
+        user = db.query(Users).filter(Users.id == payload.get('id')).first()
+        if user is None or user.role != "admin":
+            return None
+        return user.username
+    finally:
+        db.close()
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not any(name == HEADER for name, _ in scope["headers"]):
+            await self.app(scope, receive, send)
+            return
+        from utils.multithread import run_in_thread
+        headers = dict(scope["headers"])
+        username = await run_in_thread(get_admin, headers.get(b"authorization", b"").decode("latin-1"))
+        # Only admin users are profiled, the header of the others is ignored
+        if username is None:
+            await self.app(scope, receive, send)
+            return
+        request_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", request_id.encode("latin-1"))])
+            await send(message)
+
+        async with lock:
+            session = ProfileSession()
+            token = current.set(session)
+            start = time.time()
+            session.profile.enable()
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                session.profile.disable()
+                current.reset(token)
+                info = {"path": scope["path"], "query": scope.get("query_string", b"").decode("latin-1"), "user": username, "created_at": start, "duration_seconds": time.time() - start}
+                try:
+                    await run_in_thread(save_profile, request_id, session, info)
+                except Exception as e:
+                    print("Failed to save profile " + request_id + ": " + str(e))
@@ -0,0 +1,100 @@
+import time
+import threading
+import contextvars
+
+# Stage durations and counters of the request being served, sent back as a Server-Timing header
+# and X-Shard-Count, X-Bytes-Fetched and X-Dedup-Iterations headers by TimingMiddleware. Stages are
+# recorded by utils.metrics.stage_timer, also from the worker threads of utils.multithread, which
+# run in a copy of the context of the request.
+
+# Stage of utils.metrics -> Server-Timing entry, in header order
+SERVER_TIMING_NAMES = {
+    "metadata_scan": "mongo",
+    "shard_download": "s3",
+    "parse": "parse",
+    "dedup": "dedup",
+    "serialization": "serialize",
+    "api_key_consume": "key",
+}
+# Durations of stages running in parallel threads are summed
+SUMMED_STAGES = {"shard_download", "parse"}
+
+class RequestTiming:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.shard_count = 0
+        self.bytes_fetched = 0
+        self.dedup_iterations = 0
+        # The request serves data rows, it gets the X- headers
+        self.data_request = False
+
+    def add_stage(self, stage: str, seconds: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add(self, counter: str, amount: int):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def server_timing(self):
+        entries = []
+        for stage, name in SERVER_TIMING_NAMES.items():
+            if stage in self.stages:
+                entry = name + ";dur=%.1f" % (self.stages[stage] * 1000)
+                if stage in SUMMED_STAGES:
+                    entry += ';desc="summed over shards"'
+                entries.append(entry)
+        entries.append("total;dur=%.1f" % ((time.perf_counter() - self.start) * 1000))
+        return ", ".join(entries)
+
+    def headers(self):
+        headers = [(b"server-timing", self.server_timing().encode("latin-1")), (b"timing-allow-origin", b"*")]
+        if self.data_request:
+            headers.append((b"x-shard-count", str(self.shard_count).encode("latin-1")))
+            headers.append((b"x-bytes-fetched", str(self.bytes_fetched).encode("latin-1")))
+            headers.append((b"x-dedup-iterations", str(self.dedup_iterations).encode("latin-1")))
+        return headers
+
+current = contextvars.ContextVar("request_timing", default=None)
+
+def add_stage(stage: str, seconds: float):
+    timing = current.get()
+    if timing is not None:
+        timing.add_stage(stage, seconds)
+
+# Add to shard_count, bytes_fetched or dedup_iterations of the current request
+def add(counter: str, amount: int = 1):
+    timing = current.get()
+    if timing is not None:
+        timing.add(counter, amount)
+
+def mark_data_request():
+    timing = current.get()
+    if timing is not None:
+        timing.data_request = True
+
+# ASGI middleware giving every HTTP request its RequestTiming and adding its headers to the
+# response. Headers are written when the response starts: a streamed response reports the stages
+# done before its first line.
+class TimingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        timing = RequestTiming()
+        token = current.set(timing)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                message = dict(message, headers=list(message.get("headers", [])) + timing.headers())
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current.reset(token)
@@ -0,0 +1,129 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+
+from utils import log_utils, metrics
+
+# Cache of serialized data pages. Entries carry the catalogue version of their source, which is
+# bumped on every metadata change, so a page is never served from a catalogue it was not built on.
+ENABLED = os.environ.get('response_cache_enabled', 'true').lower() in ('1', 'true', 'yes')
+MEMORY_LIMIT = int(float(os.environ.get('response_cache_memory_mb', 64)) * 1024 * 1024)
+TTL = float(os.environ.get('response_cache_ttl', 30))
+# Follow metadata changes made by other servers and jobs through a change stream of the collection
+WATCH_ENABLED = os.environ.get('response_cache_watch', 'false').lower() in ('1', 'true', 'yes')
+
+# source_name -> catalogue version
+versions = {}
+
+def get_version(source_name: str):
+    return versions.get(source_name, 0)
+
+# Metadata of the source changed, cached pages of the source are stale
+def bump(source_name: str = None):
+    if source_name is None:
+        for name in list(versions):
+            versions[name] += 1
+        return
+    versions[source_name] = get_version(source_name) + 1
+
+def page_key(source_name, sortKey, searchKey, sortDirection, pageSize, pageNumber, cursor=None, fields=None, filters=None):
+    return (source_name, sortKey, searchKey, sortDirection, pageSize, pageNumber, cursor, None if fields is None else tuple(fields), None if not filters else tuple(sorted(filters.items())))
+
+class ResponseCache:
+    def __init__(self, memory_limit=MEMORY_LIMIT, ttl=TTL):
+        self.memory_limit = memory_limit
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (version, expires_at, body), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "expired": 0, "evictions": 0}
+
+    # Body of the page if it was cached on the current catalogue version of its source
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            version, expires_at, body = entry
+            if version != get_version(key[0]) or expires_at < time.time():
+                self.stats["stale" if version != get_version(key[0]) else "expired"] += 1
+                self.remove(key)
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return body
+
+    # version is the catalogue version read before the page was built
+    def put(self, key, version, body: bytes):
+        if len(body) > self.memory_limit or version != get_version(key[0]):
+            return
+        # Known to bump(None) from now on
+        versions.setdefault(key[0], version)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (version, time.time() + self.ttl, body)
+            self.size += len(body)
+            while self.size > self.memory_limit:
+                evicted_key = next(iter(self.entries))
+                self.remove(evicted_key)
+                self.stats["evictions"] += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[2])
+
+    def get_stats(self):
+        lookups = self.stats["hits"] + self.stats["misses"] + self.stats["stale"] + self.stats["expired"]
+        return dict(self.stats, hit_rate=self.stats["hits"] / lookups if lookups > 0 else 0.0, bytes=self.size, entries=len(self.entries))
+
+
+cache = ResponseCache() if ENABLED else None
+
+# Seconds before the change stream is opened again after an error, doubled up to WATCH_MAX_DELAY
+WATCH_BASE_DELAY = 1.0
+WATCH_MAX_DELAY = 60.0
+WATCH_RESTARTS = metrics.Counter("scraping_catalogue_watch_restarts_total", "Times the change stream of the shard metadata failed and was opened again.")
+
+# Bump the version of the sources whose metadata is changed by anyone. Needs a replica set, the
+# TTL still bounds staleness when change streams are not available. The stream is opened again
+# after an error, with jittered exponential backoff.
+async def watch_catalogue(mongo_collection, on_change=None):
+    attempt = 0
+    while True:
+        try:
+            async with mongo_collection.watch(full_document="updateLookup") as stream:
+                if attempt > 0:
+                    # Changes made while the stream was closed are unknown
+                    bump(None)
+                    if on_change is not None:
+                        on_change(None)
+                attempt = 0
+                async for change in stream:
+                    document = change.get("fullDocument") or {}
+                    # Deleted documents are gone, their source is unknown
+                    source_name = document.get("source_name")
+                    bump(source_name)
+                    if on_change is not None:
+                        on_change(source_name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            WATCH_RESTARTS.inc()
+            delay = random.uniform(0, min(WATCH_MAX_DELAY, WATCH_BASE_DELAY * 2 ** attempt))
+            message = "Failed to watch metadata changes with error: " + str(e) + ". Retrying in " + "%.1f" % delay + " seconds"
+            try:
+                log_utils.write_log(message + "\n", "error_log.txt")
+            except OSError:
+                print(message)
+            attempt += 1
+            await asyncio.sleep(delay)
+            continue
+        # The stream ended without error, for example when the collection was dropped
+        attempt += 1
+        await asyncio.sleep(min(WATCH_MAX_DELAY, WATCH_BASE_DELAY * 2 ** attempt))
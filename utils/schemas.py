@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+# Column types of the shards of every media. Shards are parsed with these types instead of
+# inferring them, and columns with few distinct values are categoricals.
+SCHEMAS = {
+    "reddit": {"id": "object", "url": "object", "text": "object", "likes": "float64", "dataType": "category", "timestamp": "object"},
+    "twitter": {"id": "Int64", "url": "object", "text": "object", "likes": "float64", "images": "object", "timestamp": "object"},
+    "test": {"id": "object", "url": "object", "text": "object", "likes": "float64", "dataType": "category", "timestamp": "object"},
+}
+
+# Media of a bucket named <media>scrapingbucket
+def media_of(bucket_name: str):
+    if bucket_name is None or not bucket_name.endswith("scrapingbucket"):
+        return None
+    return bucket_name[:-len("scrapingbucket")]
+
+# Types of the given columns of the shards of media, None when the media has no schema
+def get_dtypes(media: str, columns=None):
+    schema = SCHEMAS.get(media)
+    if schema is None:
+        return None
+    if columns is None:
+        return dict(schema)
+    return {name: dtype for name, dtype in schema.items() if name in columns}
+
+# Formats with their own types (parquet) only get the categoricals of the schema
+def apply_categories(df: pd.DataFrame, media: str):
+    for name, dtype in (SCHEMAS.get(media) or {}).items():
+        if dtype == "category" and name in df.columns and not isinstance(df[name].dtype, pd.CategoricalDtype):
+            df[name] = df[name].astype("category")
+    return df
+
+# File name of every row as a categorical column, one code per row instead of one string
+def tag_file(df: pd.DataFrame, key: str):
+    df['csv_file'] = pd.Categorical.from_codes(np.zeros(len(df.index), dtype="int8"), categories=[key])
+    return df
+
+# Frames concatenated in one copy. Categorical columns get the union of their categories first,
+# pd.concat would turn categoricals with different categories into object columns.
+def concat_frames(frames):
+    frames = [frame for frame in frames if frame is not None and len(frame.columns) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    categorical = [name for name in frames[0].columns if all(name in frame.columns and isinstance(frame[name].dtype, pd.CategoricalDtype) for frame in frames)]
+    if len(categorical) > 0 and len(frames) > 1:
+        dtypes = {name: pd.CategoricalDtype(pd.Index(pd.unique(np.concatenate([frame[name].cat.categories.to_numpy(dtype=object) for frame in frames])))) for name in categorical}
+        frames = [frame.astype(dtypes, copy=False) for frame in frames]
+    return pd.concat(frames, ignore_index=True)
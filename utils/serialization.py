@@ -0,0 +1,76 @@
+import json
+import typing
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Encodes data pages straight from the DataFrame into response bytes. Instead of validating every
+# row with pydantic, the columns of a frame are checked once against the response model and cast
+# to the documented types.
+
+# Column plans per (model, columns, dtypes)
+plans = {}
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+# Optional[int] -> int
+def field_type(annotation):
+    args = [arg for arg in typing.get_args(annotation) if arg is not type(None)]
+    return args[0] if len(args) > 0 else annotation
+
+# Columns of the model present in the frame, in model order, with the cast each of them needs
+def get_plan(df: pd.DataFrame, model):
+    key = (model, tuple(df.columns), tuple(str(dtype) for dtype in df.dtypes))
+    plan = plans.get(key)
+    if plan is not None:
+        return plan
+    plan = []
+    for name, field in model.model_fields.items():
+        if name not in df.columns:
+            if field.is_required():
+                raise Exception("Invalid shard schema, column " + name + " is missing.")
+            continue
+        expected = field_type(field.annotation)
+        dtype = df[name].dtype
+        cast = None
+        if expected is int and not pd.api.types.is_integer_dtype(dtype):
+            cast = "Int64"
+        elif expected is str and not (pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype) or isinstance(dtype, pd.CategoricalDtype)):
+            cast = "string"
+        plan.append((name, cast))
+    plans[key] = plan
+    return plan
+
+def cast_column(column: pd.Series, cast: str):
+    if cast == "Int64":
+        if pd.api.types.is_object_dtype(column.dtype):
+            column = pd.to_numeric(column)
+        return column.astype("Int64")
+    return column.astype(cast)
+
+# Frame with only the model columns, in model order and with the model types
+def prepare_frame(df: pd.DataFrame, model):
+    plan = get_plan(df, model)
+    columns = {name: df[name] if cast is None else cast_column(df[name], cast) for name, cast in plan}
+    return pd.DataFrame(columns, copy=False)
+
+def encode_records(df: pd.DataFrame, model):
+    return prepare_frame(df, model).to_json(orient="records").encode("utf-8")
+
+def encode_lines(df: pd.DataFrame, model):
+    lines = prepare_frame(df, model).to_json(orient="records", lines=True)
+    return (lines if lines.endswith("\n") else lines + "\n").encode("utf-8")
+
+# JSON object of the envelope fields followed by the "data" array of the frame rows
+def encode_response(envelope: dict, df: pd.DataFrame, model):
+    head = dumps(envelope)
+    records = encode_records(df, model)
+    if head == b"{}":
+        return b'{"data":' + records + b"}"
+    return head[:-1] + b',"data":' + records + b"}"
@@ -0,0 +1,220 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils import schemas, metrics
+from utils.shard_reader import read_shard
+
+# Two tier cache of whole shards in front of the S3 bucket: parsed DataFrames in memory and raw
+# bytes on local disk, both validated against the S3 ETag of the object.
+ENABLED = os.environ.get('shard_cache_enabled', 'true').lower() in ('1', 'true', 'yes')
+MEMORY_LIMIT = int(float(os.environ.get('shard_cache_memory_mb', 256)) * 1024 * 1024)
+DISK_LIMIT = int(float(os.environ.get('shard_cache_disk_mb', 1024)) * 1024 * 1024)
+DISK_DIRECTORY = os.environ.get('shard_cache_directory', 'cache/shards')
+# Entries younger than this are served without asking S3 whether the object changed
+REVALIDATE_SECONDS = float(os.environ.get('shard_cache_revalidate_seconds', 60))
+
+class ShardCache:
+    def __init__(self, memory_limit=MEMORY_LIMIT, disk_limit=DISK_LIMIT, directory=DISK_DIRECTORY):
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.directory = directory
+        self.lock = threading.Lock()
+        # key -> {"df", "etag", "file_format", "size", "validated_at"}, least recently used first
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        # key -> size of the file on disk, least recently used first
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "memory_evictions": 0, "disk_evictions": 0, "revalidations": 0, "revalidation_errors": 0, "invalidations": 0}
+        if self.disk_limit > 0:
+            self.load_disk()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1("/".join(key).encode()).hexdigest())
+
+    # Pick up files left by a previous process, oldest first
+    def load_disk(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    meta = json.load(file)
+                data_path = os.path.join(self.directory, name[:-5])
+                entries.append((os.path.getmtime(data_path), tuple(meta["key"]), os.path.getsize(data_path)))
+            except Exception:
+                continue
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+            self.disk_size += size
+
+    # Whole shard as a DataFrame, or None when it is not cached. Entries older than
+    # REVALIDATE_SECONDS are checked with a conditional GET and refreshed if the object changed.
+    def get(self, s3_client, bucket_name, key, file_format="csv"):
+        cache_key = (bucket_name, key)
+        with self.lock:
+            entry = self.memory.get(cache_key)
+            if entry is not None:
+                self.memory.move_to_end(cache_key)
+        if entry is not None:
+            if self.is_fresh(s3_client, cache_key, entry):
+                self.stats["memory_hits"] += 1
+                return entry["df"].copy(deep=False)
+            return self.get(s3_client, bucket_name, key, file_format)
+
+        meta = self.read_disk_meta(cache_key)
+        if meta is None:
+            self.stats["misses"] += 1
+            return None
+        entry = {"etag": meta["etag"], "file_format": meta.get("file_format", file_format), "validated_at": meta["validated_at"]}
+        if not self.is_fresh(s3_client, cache_key, entry):
+            return self.get(s3_client, bucket_name, key, file_format)
+        try:
+            with open(self.path(cache_key), "rb") as file:
+                data = file.read()
+        except OSError:
+            self.stats["misses"] += 1
+            return None
+        df = read_shard(data, entry["file_format"], None, schemas.media_of(bucket_name))
+        self.put_memory(cache_key, df, entry["etag"], entry["file_format"], entry["validated_at"])
+        with self.lock:
+            if cache_key in self.disk:
+                self.disk.move_to_end(cache_key)
+        self.stats["disk_hits"] += 1
+        return df.copy(deep=False)
+
+    # Entry is fresh, or still matches the object in S3. A changed object replaces the entry.
+    def is_fresh(self, s3_client, cache_key, entry):
+        if time.time() - entry["validated_at"] < REVALIDATE_SECONDS:
+            return True
+        self.stats["revalidations"] += 1
+        bucket_name, key = cache_key
+        try:
+            obj = s3_client.get_object(Bucket=bucket_name, Key=key, IfNoneMatch=entry["etag"])
+        except Exception as e:
+            response = getattr(e, "response", None) or {}
+            status_code = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+            if status_code == 304:
+                entry["validated_at"] = time.time()
+                self.touch_disk_meta(cache_key, entry["validated_at"])
+                return True
+            # Only a deleted object drops the entry, it is served as is when S3 could not be reached
+            if status_code == 404 or response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+                self.invalidate(bucket_name, key)
+                return False
+            self.stats["revalidation_errors"] += 1
+            print("Failed to revalidate " + key + " in the shard cache: " + str(e))
+            return True
+        data = obj['Body'].read()
+        metrics.add_bytes_fetched(schemas.media_of(bucket_name), len(data))
+        file_format = entry["file_format"]
+        self.invalidate(bucket_name, key)
+        self.put(bucket_name, key, data, obj['ETag'], file_format, read_shard(data, file_format, None, schemas.media_of(bucket_name)))
+        return False
+
+    def put(self, bucket_name, key, data: bytes, etag: str, file_format: str, df):
+        cache_key = (bucket_name, key)
+        now = time.time()
+        self.put_memory(cache_key, df, etag, file_format, now)
+        if self.disk_limit > 0 and len(data) <= self.disk_limit:
+            self.put_disk(cache_key, data, etag, file_format, now)
+
+    def put_memory(self, cache_key, df, etag, file_format, validated_at):
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.memory_limit:
+            return
+        with self.lock:
+            previous = self.memory.pop(cache_key, None)
+            if previous is not None:
+                self.memory_size -= previous["size"]
+            self.memory[cache_key] = {"df": df, "etag": etag, "file_format": file_format, "size": size, "validated_at": validated_at}
+            self.memory_size += size
+            while self.memory_size > self.memory_limit:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_size -= evicted["size"]
+                self.stats["memory_evictions"] += 1
+
+    def put_disk(self, cache_key, data, etag, file_format, validated_at):
+        path = self.path(cache_key)
+        try:
+            # Write then rename so that readers never see a partial file
+            with open(path + ".tmp", "wb") as file:
+                file.write(data)
+            os.replace(path + ".tmp", path)
+            with open(path + ".json", "w") as file:
+                json.dump({"key": list(cache_key), "etag": etag, "file_format": file_format, "validated_at": validated_at}, file)
+        except OSError as e:
+            print("Failed to write shard cache file: " + str(e))
+            return
+        evicted = []
+        with self.lock:
+            self.disk_size -= self.disk.pop(cache_key, 0)
+            self.disk[cache_key] = len(data)
+            self.disk_size += len(data)
+            while self.disk_size > self.disk_limit:
+                evicted_key, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                self.stats["disk_evictions"] += 1
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            self.remove_disk(evicted_key)
+
+    def read_disk_meta(self, cache_key):
+        if cache_key not in self.disk:
+            return None
+        try:
+            with open(self.path(cache_key) + ".json") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def touch_disk_meta(self, cache_key, validated_at):
+        meta = self.read_disk_meta(cache_key)
+        if meta is None:
+            return
+        meta["validated_at"] = validated_at
+        try:
+            with open(self.path(cache_key) + ".json", "w") as file:
+                json.dump(meta, file)
+        except OSError:
+            pass
+
+    def remove_disk(self, cache_key):
+        path = self.path(cache_key)
+        for file_path in (path, path + ".json"):
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+
+    # Entry exists in either tier, without validating it
+    def contains(self, bucket_name, key):
+        cache_key = (bucket_name, key)
+        with self.lock:
+            return cache_key in self.memory or cache_key in self.disk
+
+    # Called when this server rewrites or deletes an object
+    def invalidate(self, bucket_name, key):
+        cache_key = (bucket_name, key)
+        with self.lock:
+            entry = self.memory.pop(cache_key, None)
+            if entry is not None:
+                self.memory_size -= entry["size"]
+            on_disk = self.disk.pop(cache_key, None)
+            if on_disk is not None:
+                self.disk_size -= on_disk
+        if on_disk is not None:
+            self.remove_disk(cache_key)
+        self.stats["invalidations"] += 1
+
+    def get_stats(self):
+        return dict(self.stats, memory_bytes=self.memory_size, memory_entries=len(self.memory), disk_bytes=self.disk_size, disk_entries=len(self.disk))
+
+
+cache = ShardCache(disk_limit=DISK_LIMIT) if ENABLED else None
@@ -0,0 +1,116 @@
+import os
+import json
+
+from utils import schemas, metrics
+from utils.shard_reader import read_shard
+
+# Sidecar index of a csv shard: the byte offset of every Nth data row, so that a page only
+# needs a ranged GET of the rows it covers instead of the whole file.
+ENABLED = os.environ.get('shard_index_enabled', 'false').lower() in ('1', 'true', 'yes')
+STRIDE = int(os.environ.get('shard_index_stride', 1000))
+INDEX_PREFIX = ".index/"
+
+# Cached sidecars, keyed by (bucket_name, key)
+indexes = {}
+
+def sidecar_key(key):
+    return INDEX_PREFIX + key + ".json"
+
+# Byte offsets of the start of every row of a csv file, header excluded. Newlines inside
+# quoted fields do not end a row, so quotes are counted between newlines.
+def row_offsets(data: bytes):
+    offsets = []
+    in_quotes = False
+    position = 0
+    size = len(data)
+    while position < size:
+        newline = data.find(b"\n", position)
+        if newline == -1:
+            newline = size
+        if data.count(b'"', position, newline) % 2 == 1:
+            in_quotes = not in_quotes
+        position = newline + 1
+        if not in_quotes and position < size:
+            offsets.append(position)
+    return offsets
+
+def build_index(data: bytes, etag: str, stride: int = STRIDE):
+    offsets = row_offsets(data)
+    header_end = offsets[0] if offsets else len(data)
+    return {
+        "etag": etag,
+        "stride": stride,
+        "size": len(data),
+        "row_count": len(offsets),
+        "header": data[:header_end].decode("utf-8"),
+        "offsets": offsets[::stride],
+    }
+
+# Build and upload the sidecar of a shard that has just been downloaded in full
+def save_index(s3_client, bucket_name, key, data: bytes, etag: str):
+    index = build_index(data, etag)
+    indexes[(bucket_name, key)] = index
+    try:
+        s3_client.put_object(Bucket=bucket_name, Key=sidecar_key(key), Body=json.dumps(index).encode())
+    except Exception as e:
+        print("Failed to upload shard index of " + key + ": " + str(e))
+    return index
+
+# Sidecar of a shard that has just been downloaded in full. It is only built and uploaded when
+# neither memory nor the bucket has one for the ETag of the shard.
+def ensure_index(s3_client, bucket_name, key, data: bytes, etag: str):
+    index = load_index(s3_client, bucket_name, key)
+    if index is not None and index.get("etag") == etag:
+        return index
+    return save_index(s3_client, bucket_name, key, data, etag)
+
+def load_index(s3_client, bucket_name, key):
+    index = indexes.get((bucket_name, key))
+    if index is not None:
+        return index
+    try:
+        obj = s3_client.get_object(Bucket=bucket_name, Key=sidecar_key(key))
+        index = json.loads(obj['Body'].read())
+    except Exception:
+        return None
+    indexes[(bucket_name, key)] = index
+    return index
+
+def remove_index(s3_client, bucket_name, key):
+    indexes.pop((bucket_name, key), None)
+    try:
+        s3_client.delete_object(Bucket=bucket_name, Key=sidecar_key(key))
+    except Exception as e:
+        print("Failed to delete shard index of " + key + ": " + str(e))
+
+# Read rows [start_row, end_row) of a shard with a ranged GET. Returns the DataFrame and the
+# row number of its first row, which is start_row rounded down to the index stride, or None
+# when there is no valid index and the shard has to be downloaded in full.
+def read_rows(s3_client, bucket_name, key, start_row, end_row, columns=None):
+    index = load_index(s3_client, bucket_name, key)
+    if index is None:
+        return None
+    stride = index["stride"]
+    offsets = index["offsets"]
+    end_row = min(end_row, index["row_count"])
+    if start_row >= end_row:
+        return read_shard(index["header"].encode("utf-8"), "csv", columns, schemas.media_of(bucket_name)), start_row
+
+    first_block = start_row // stride
+    last_block = (end_row + stride - 1) // stride
+    byte_start = offsets[first_block]
+    byte_end = offsets[last_block] - 1 if last_block < len(offsets) else index["size"] - 1
+
+    media = schemas.media_of(bucket_name)
+    with metrics.stage_timer("shard_download", media):
+        obj = s3_client.get_object(Bucket=bucket_name, Key=key, Range="bytes=%d-%d" % (byte_start, byte_end))
+        # The shard was rewritten since the index was built
+        if obj.get('ETag') != index["etag"]:
+            indexes.pop((bucket_name, key), None)
+            return None
+        body = obj['Body'].read()
+    metrics.add_bytes_fetched(media, len(body))
+    with metrics.stage_timer("parse", media):
+        df = read_shard(index["header"].encode("utf-8") + body, "csv", columns, media)
+    metrics.ROWS_FETCHED.labels(media or "").inc(len(df.index))
+    return df, first_block * stride
@@ -0,0 +1,73 @@
+import os
+import io
+import csv
+import pandas as pd
+
+from utils import schemas
+
+# Shards are csv files unless their metadata document says "file_format": "parquet"
+FILE_FORMATS = ["csv", "parquet"]
+# Parser of csv shards, "c" or "pyarrow" (multithreaded, needs pyarrow)
+CSV_ENGINE = os.environ.get('csv_engine', 'c')
+
+# Parse a shard from bytes or a file-like body, reading only the given columns when columns is not None.
+# Shards of a media with a schema in utils/schemas.py are parsed with its types.
+def read_shard(body, file_format: str = "csv", columns: list = None, media: str = None):
+    if isinstance(body, bytes):
+        body = io.BytesIO(body)
+    if file_format == "parquet":
+        # pyarrow is only needed once parquet shards exist
+        import pyarrow.parquet as pq
+        if not isinstance(body, io.BytesIO):
+            body = io.BytesIO(body.read())
+        parquet_file = pq.ParquetFile(body)
+        if columns is not None:
+            columns = [column for column in columns if column in parquet_file.schema_arrow.names]
+        return schemas.apply_categories(parquet_file.read(columns=columns).to_pandas(), media)
+    if not isinstance(body, io.BytesIO):
+        body = io.BytesIO(body.read())
+    return read_csv(body, columns, schemas.get_dtypes(media, columns))
+
+def read_csv(body: io.BytesIO, columns: list = None, dtypes: dict = None):
+    options = {}
+    if CSV_ENGINE == "pyarrow":
+        # The pyarrow parser takes a list of columns that must all exist
+        first_line = body.getvalue().split(b"\n", 1)[0].decode("utf-8-sig").rstrip("\r")
+        header = next(csv.reader([first_line]), [])
+        options["engine"] = "pyarrow"
+        options["usecols"] = header if columns is None else [column for column in header if column in columns]
+        if dtypes is not None:
+            dtypes = {name: dtype for name, dtype in dtypes.items() if name in options["usecols"]}
+    elif columns is not None:
+        options["usecols"] = lambda column: column in columns
+    try:
+        return pd.read_csv(body, dtype=dtypes, **options)
+    except (ValueError, TypeError) as e:
+        if dtypes is None:
+            raise
+        # Values that do not fit the schema, the types are inferred instead
+        print("Failed to parse shard with its schema, inferring types: " + str(e))
+        body.seek(0)
+        return pd.read_csv(body, **options)
+
+# Keep only the given columns of an already parsed shard, as a new frame safe to add columns to
+def project_columns(df: pd.DataFrame, columns: list = None):
+    if columns is None:
+        return df
+    return df[[column for column in df.columns if column in columns]].copy(deep=False)
+
+def write_shard(df: pd.DataFrame, file_format: str = "csv"):
+    if file_format == "parquet":
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False, compression="zstd")
+        return buffer.getvalue()
+    return df.to_csv(index=False).encode("utf-8")
+
+# Format of a shard from its file name, for code paths without its metadata document
+def file_format_of(file_name: str):
+    if file_name.endswith(".parquet"):
+        return "parquet"
+    return "csv"
+
+def shard_file_name(file_name: str, file_format: str):
+    return file_name.rsplit(".", 1)[0] + "." + file_format
@@ -0,0 +1,184 @@
+import asyncio
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from utils.multithread import run_in_thread
+
+# Statistics of the rows of a shard kept in its metadata document: min/max timestamp and likes.
+# Range filters skip the shards whose range cannot match in the MongoDB query, take the shards
+# whose range is inside the filter as a whole, and only read the timestamp and likes columns of
+# the shards that match partly once a requested page reaches them.
+#
+# The metadata document also keeps a rollup of the rows of the shard, the partial aggregates of
+# the stats endpoints: per day of timestamp, the number of rows, the sum of likes and a histogram
+# of likes. A stats query merges the rollups of the shards instead of reading their rows.
+#
+# Backfill shards without statistics from the root directory: python -m utils.shard_stats --media reddit
+COLLECTION_NAME = "scraping"
+ZONE_FIELDS = ["min_timestamp", "max_timestamp", "min_likes", "max_likes"]
+ZONE_PROJECTION = {field: 1 for field in ZONE_FIELDS}
+FILTER_NAMES = ["from", "to", "min_likes"]
+FILTER_COLUMNS = ["timestamp", "likes"]
+# Lower bounds of the likes histogram bins, the last bin has no upper bound
+LIKES_BINS = [0, 1, 10, 100, 1000, 10000]
+LIKES_BIN_LABELS = ["0", "1-9", "10-99", "100-999", "1000-9999", "10000+"]
+GROUP_BY = ["day", "keyword", "likes"]
+
+def to_timestamp(value):
+    if value is None:
+        return None
+    timestamp = pd.Timestamp(value)
+    return timestamp.tz_localize("UTC") if timestamp.tzinfo is None else timestamp.tz_convert("UTC")
+
+def parse_timestamps(column: pd.Series):
+    return pd.to_datetime(column, utc=True, errors="coerce")
+
+# Fields of the metadata document of a shard
+def compute_stats(df: pd.DataFrame):
+    stats = {"row_count": len(df.index)}
+    if "timestamp" in df.columns:
+        timestamps = parse_timestamps(df["timestamp"]).dropna()
+        if len(timestamps.index) > 0:
+            stats["min_timestamp"] = timestamps.min().to_pydatetime()
+            stats["max_timestamp"] = timestamps.max().to_pydatetime()
+    if "likes" in df.columns:
+        likes = pd.to_numeric(df["likes"], errors="coerce").dropna()
+        if len(likes.index) > 0:
+            stats["min_likes"] = likes.min().item()
+            stats["max_likes"] = likes.max().item()
+    return stats
+
+# {"days": {"YYYY-MM-DD": [rows, sum of likes, rows of each likes bin...]}}, rows without a valid
+# timestamp are under the day ""
+def compute_rollup(df: pd.DataFrame):
+    if len(df.index) == 0:
+        return {"days": {}}
+    timestamps = parse_timestamps(df["timestamp"]) if "timestamp" in df.columns else pd.Series(pd.NaT, index=df.index)
+    likes = pd.to_numeric(df["likes"], errors="coerce").fillna(0) if "likes" in df.columns else pd.Series(0.0, index=df.index)
+    frame = pd.DataFrame({
+        "day": timestamps.dt.strftime("%Y-%m-%d").fillna(""),
+        "likes": likes,
+        "bin": np.digitize(likes.to_numpy(), LIKES_BINS[1:]),
+    })
+    histogram = pd.crosstab(frame["day"], frame["bin"]).reindex(columns=range(len(LIKES_BINS)), fill_value=0)
+    grouped = frame.groupby("day")["likes"].agg(["size", "sum"])
+    return {"days": {day: [int(grouped.at[day, "size"]), float(grouped.at[day, "sum"])] + [int(count) for count in histogram.loc[day]] for day in grouped.index}}
+
+# Merge the rollups of the metadata documents into aggregates grouped by day, keyword (the search
+# key of the shard) or likes bin, over the days in [from_day, to_day] when given
+def merge_rollups(documents, group_by: str, from_day: str = None, to_day: str = None):
+    columns = ["keyword", "day", "count", "likes"] + LIKES_BIN_LABELS
+    records = []
+    for document in documents:
+        keyword = (document.get("search_keys") or [None])[0]
+        for day, values in document["rollup"]["days"].items():
+            records.append([keyword, day] + values)
+    frame = pd.DataFrame(records, columns=columns)
+    if from_day is not None:
+        frame = frame[(frame["day"] != "") & (frame["day"] >= from_day)]
+    if to_day is not None:
+        frame = frame[(frame["day"] != "") & (frame["day"] <= to_day)]
+    totals = {"count": int(frame["count"].sum()), "likes": float(frame["likes"].sum())}
+    if group_by == "likes":
+        counts = frame[LIKES_BIN_LABELS].sum()
+        return totals, [{"key": label, "count": int(counts[label])} for label in LIKES_BIN_LABELS]
+    grouped = frame.groupby(group_by, dropna=False)[["count", "likes"]].sum().sort_index()
+    return totals, [{"key": key if key == key else None, "count": int(row["count"]), "likes": float(row["likes"])} for key, row in grouped.iterrows()]
+
+def has_zone_filters(filters):
+    return bool(filters) and any(filters.get(name) is not None for name in FILTER_NAMES)
+
+# MongoDB condition dropping the shards whose statistics cannot match, shards without statistics are kept
+def zone_query(filters):
+    conditions = []
+    if filters.get("from") is not None:
+        conditions.append({"$or": [{"max_timestamp": {"$exists": False}}, {"max_timestamp": {"$gte": to_timestamp(filters["from"]).to_pydatetime()}}]})
+    if filters.get("to") is not None:
+        conditions.append({"$or": [{"min_timestamp": {"$exists": False}}, {"min_timestamp": {"$lte": to_timestamp(filters["to"]).to_pydatetime()}}]})
+    if filters.get("min_likes") is not None:
+        conditions.append({"$or": [{"max_likes": {"$exists": False}}, {"max_likes": {"$gte": filters["min_likes"]}}]})
+    return {"$and": conditions} if len(conditions) > 0 else {}
+
+# Every row of the shard matches, by its statistics
+def zone_contains(zone: dict, filters):
+    if filters.get("from") is not None and (zone.get("min_timestamp") is None or to_timestamp(zone["min_timestamp"]) < to_timestamp(filters["from"])):
+        return False
+    if filters.get("to") is not None and (zone.get("max_timestamp") is None or to_timestamp(zone["max_timestamp"]) > to_timestamp(filters["to"])):
+        return False
+    if filters.get("min_likes") is not None and (zone.get("min_likes") is None or zone["min_likes"] < filters["min_likes"]):
+        return False
+    return True
+
+# Rows of df matching the filters
+def row_mask(df: pd.DataFrame, filters):
+    mask = pd.Series(True, index=df.index)
+    if filters.get("from") is not None or filters.get("to") is not None:
+        timestamps = parse_timestamps(df["timestamp"]) if "timestamp" in df.columns else pd.Series(pd.NaT, index=df.index)
+        if filters.get("from") is not None:
+            mask &= timestamps >= to_timestamp(filters["from"])
+        if filters.get("to") is not None:
+            mask &= timestamps <= to_timestamp(filters["to"])
+    if filters.get("min_likes") is not None:
+        likes = pd.to_numeric(df["likes"], errors="coerce") if "likes" in df.columns else pd.Series(float("nan"), index=df.index)
+        mask &= likes >= filters["min_likes"]
+    return mask
+
+# Page map documents of the rows matching the range filters. Shards inside the filters keep their
+# rows. The others are marked "pending" with their row count as an upper bound: their timestamp and
+# likes columns are only read, by match_rows, when a page reaches them.
+def mark_partial(documents, filters):
+    marked = []
+    for file_name, row_count, attributes in documents:
+        if zone_contains(attributes.get("zone", {}), filters):
+            marked.append((file_name, row_count, attributes))
+        else:
+            marked.append((file_name, row_count, dict(attributes, pending=True)))
+    return marked
+
+# Matching rows of a pending shard, df holding its timestamp and likes columns. Rows left by other
+# filters are kept in attributes["rows"], rows whose url is in an earlier shard are not served.
+def match_rows(df: pd.DataFrame, filters, attributes):
+    rows = df.index[row_mask(df, filters).to_numpy()].tolist()
+    if attributes.get("rows") is not None:
+        rows = sorted(set(rows) & set(attributes["rows"]))
+    duplicate_rows = set(attributes.get("duplicate_rows") or ())
+    return [row for row in rows if row not in duplicate_rows]
+
+async def backfill(media: str, recompute: bool):
+    from utils import data_access, log_utils
+    from utils.metadata_writer import MetadataWriter
+    mongo_collection = data_access.MongoClient['scraping'][COLLECTION_NAME]
+    query = {"source_name": media} if recompute else {"source_name": media, "$or": [{"min_timestamp": {"$exists": False}}, {"rollup": {"$exists": False}}]}
+    documents = [document async for document in mongo_collection.find(query, {"file_name": 1, "file_format": 1, "duplicate_rows": 1})]
+    writer = MetadataWriter(media, COLLECTION_NAME)
+    for document in documents:
+        file_name = document["file_name"]
+        try:
+            df, _ = await run_in_thread(data_access.download_shard, media + 'scrapingbucket', media + "/", file_name, document.get("file_format", "csv"), columns=FILTER_COLUMNS)
+            stats = compute_stats(df)
+            # row_count is left to the writers of the shard
+            stats.pop("row_count")
+            # Rows whose url is in an earlier shard are not counted
+            duplicate_rows = document.get("duplicate_rows") or []
+            stats["rollup"] = compute_rollup(df.drop(index=duplicate_rows) if len(duplicate_rows) > 0 else df)
+            writer.set_fields(file_name, stats)
+            print("Computed statistics of " + file_name)
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to compute statistics of shard with error: " + str(e) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+    failed = [file_name for file_name, response in (await writer.flush()).items() if not response["success"]]
+    for file_name in failed:
+        log_utils.write_log("Failed to write statistics of shard. File name: " + str(file_name) + "\n", "error_log.txt")
+    print("Computed statistics of " + str(len(documents) - len(failed)) + " shards of " + media)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--media", required=True, choices=["reddit", "twitter", "test"])
+    parser.add_argument("--all", action="store_true", help="compute the statistics and rollups of every shard instead of only the shards without them")
+    args = parser.parse_args()
+    asyncio.run(backfill(args.media, args.all))
+
+if __name__ == "__main__":
+    main()
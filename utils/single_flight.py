@@ -0,0 +1,66 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# Concurrent calls with the same key share the work of the first one. Results are shared, so
+# callers must not modify them in place.
+
+class SingleFlight:
+    """Coalesce identical coroutine calls running on the event loop."""
+
+    def __init__(self):
+        self.calls = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    async def do(self, key, method, *args, **kwargs):
+        self.stats["calls"] += 1
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(method(*args, **kwargs))
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self.forget(key, done))
+        else:
+            self.stats["shared"] += 1
+        # A caller that goes away does not cancel the work the others wait for
+        return await asyncio.shield(task)
+
+    def forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+    def get_stats(self):
+        return dict(self.stats, in_flight=len(self.calls))
+
+class ThreadSingleFlight:
+    """Coalesce identical blocking calls running in worker threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.stats = {"calls": 0, "shared": 0}
+
+    def do(self, key, method, *args, **kwargs):
+        with self.lock:
+            self.stats["calls"] += 1
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+            else:
+                self.stats["shared"] += 1
+        if not leader:
+            return future.result()
+        try:
+            result = method(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def get_stats(self):
+        return dict(self.stats, in_flight=len(self.calls))
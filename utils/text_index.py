@@ -0,0 +1,225 @@
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+
+from utils.multithread import parallel_async, run_in_thread
+
+# Inverted index of the text column of the shards of a media, stored in the bucket next to them:
+# a dictionary of term -> shards of the media, and per shard the postings term -> row numbers.
+# A text query reads the dictionary to find the shards containing every term, then their postings
+# to find the rows, so only the matching rows of the matching shards are fetched.
+# Compaction and conversion index the shards they write. Build or update the index of the other
+# shards from the root directory: python -m utils.text_index --media reddit
+INDEX_PREFIX = ".text_index/"
+TOKEN = re.compile(r"\w+")
+MIN_TERM_LENGTH = 2
+# Seconds before a dictionary cached in memory is read again from the bucket
+DICTIONARY_TTL = float(os.environ.get('text_index_ttl', 300))
+# Postings of that many shards are kept in memory
+CACHED_POSTINGS = int(os.environ.get('text_index_cached_shards', 256))
+COLLECTION_NAME = "scraping"
+
+def tokenize(text) -> set:
+    if not isinstance(text, str):
+        return set()
+    return {term for term in TOKEN.findall(text.lower()) if len(term) >= MIN_TERM_LENGTH}
+
+# term -> sorted row numbers of the texts containing it
+def build_postings(texts):
+    postings = {}
+    for row, text in enumerate(texts):
+        for term in tokenize(text):
+            postings.setdefault(term, []).append(row)
+    return postings
+
+def dictionary_key(media: str):
+    return INDEX_PREFIX + media + ".json.gz"
+
+def postings_key(file_name: str):
+    return INDEX_PREFIX + "shards/" + file_name + ".json.gz"
+
+def dumps(obj) -> bytes:
+    return gzip.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8"))
+
+def loads(data: bytes):
+    return json.loads(gzip.decompress(data))
+
+class TextIndex:
+    def __init__(self, file_names=(), terms=None, row_counts=None):
+        self.file_names = list(file_names)
+        # Rows of every shard when it was indexed, a shard rewritten since then is indexed again
+        self.row_counts = list(row_counts) if row_counts is not None else [None] * len(self.file_names)
+        self.file_ids = {file_name: file_id for file_id, file_name in enumerate(self.file_names)}
+        # term -> ids of the shards containing it
+        self.terms = {term: set(file_ids) for term, file_ids in (terms or {}).items()}
+
+    def add_shard(self, file_name: str, postings: dict, row_count: int):
+        file_id = self.file_ids.get(file_name)
+        if file_id is None:
+            file_id = len(self.file_names)
+            self.file_ids[file_name] = file_id
+            self.file_names.append(file_name)
+            self.row_counts.append(row_count)
+        self.row_counts[file_id] = row_count
+        for term in postings:
+            self.terms.setdefault(term, set()).add(file_id)
+
+    # Shards containing every term
+    def files_with(self, terms) -> set:
+        file_ids = None
+        for term in terms:
+            term_file_ids = self.terms.get(term, set())
+            file_ids = set(term_file_ids) if file_ids is None else file_ids & term_file_ids
+            if len(file_ids) == 0:
+                break
+        return {self.file_names[file_id] for file_id in file_ids or ()}
+
+    def is_indexed(self, file_name: str, row_count: int):
+        file_id = self.file_ids.get(file_name)
+        return file_id is not None and self.row_counts[file_id] == row_count
+
+    def dumps(self) -> bytes:
+        return dumps({"file_names": self.file_names, "row_counts": self.row_counts, "terms": {term: sorted(file_ids) for term, file_ids in self.terms.items()}})
+
+    @classmethod
+    def loads(cls, data: bytes):
+        index = loads(data)
+        return cls(index["file_names"], index["terms"], index.get("row_counts"))
+
+lock = threading.Lock()
+# media -> (loaded_at, TextIndex)
+dictionaries = {}
+# (bucket_name, file_name, row_count) -> postings, least recently used first
+postings_cache = OrderedDict()
+
+def load_dictionary(s3_client, media: str, cached=True):
+    entry = dictionaries.get(media)
+    if cached and entry is not None and time.time() - entry[0] < DICTIONARY_TTL:
+        return entry[1]
+    try:
+        obj = s3_client.get_object(Bucket=media + 'scrapingbucket', Key=dictionary_key(media))
+        index = TextIndex.loads(obj['Body'].read())
+    except Exception as e:
+        if getattr(e, "response", {}).get("Error", {}).get("Code") not in ("NoSuchKey", "404"):
+            raise
+        index = TextIndex()
+    dictionaries[media] = (time.time(), index)
+    return index
+
+def save_dictionary(s3_client, media: str, index: TextIndex):
+    s3_client.put_object(Bucket=media + 'scrapingbucket', Key=dictionary_key(media), Body=index.dumps())
+    dictionaries[media] = (time.time(), index)
+
+# row_count tells apart the postings of a shard indexed again after a rewrite
+def load_postings(s3_client, bucket_name: str, prefix: str, file_name: str, row_count: int = None):
+    cache_key = (bucket_name, file_name, row_count)
+    with lock:
+        postings = postings_cache.get(cache_key)
+        if postings is not None:
+            postings_cache.move_to_end(cache_key)
+            return postings
+    obj = s3_client.get_object(Bucket=bucket_name, Key=postings_key(prefix + file_name))
+    postings = loads(obj['Body'].read())
+    with lock:
+        postings_cache[cache_key] = postings
+        while len(postings_cache) > CACHED_POSTINGS:
+            postings_cache.popitem(last=False)
+    return postings
+
+def save_postings(s3_client, bucket_name: str, prefix: str, file_name: str, postings: dict):
+    s3_client.put_object(Bucket=bucket_name, Key=postings_key(prefix + file_name), Body=dumps(postings))
+
+# Sorted row numbers containing every term
+def matching_rows(postings: dict, terms) -> list:
+    rows = None
+    for term in terms:
+        term_rows = postings.get(term, [])
+        rows = set(term_rows) if rows is None else rows & set(term_rows)
+        if len(rows) == 0:
+            break
+    return sorted(rows or ())
+
+# Rows of texts containing every term of text, among rows when given
+def scan_rows(texts, text: str, rows=None) -> list:
+    terms = tokenize(text)
+    return [row for row, value in enumerate(texts) if (rows is None or row in rows) and terms <= tokenize(value)]
+
+# Page map documents of the rows matching text: the shards of documents (in their order) that
+# contain every term, with the number of matching rows as row count and the rows as "rows".
+# Shards that are not indexed yet, or were rewritten since, are marked "pending" and "scan_text":
+# their text column is scanned when a page reaches them, see utils.data_access.settle_rows.
+async def match_documents(s3_client, media: str, documents, text: str):
+    terms = tokenize(text)
+    if len(terms) == 0:
+        raise Exception("Invalid input of text, please enter at least one word of " + str(MIN_TERM_LENGTH) + " characters.")
+    index = await run_in_thread(load_dictionary, s3_client, media)
+    candidates = index.files_with(terms)
+    indexed = [index.is_indexed(document[0], document[2].get("file_row_count")) for document in documents]
+    documents = [(document, is_indexed) for document, is_indexed in zip(documents, indexed) if document[0] in candidates or not is_indexed]
+
+    def load_rows(document):
+        file_name, _, attributes = document
+        rows = matching_rows(load_postings(s3_client, media + 'scrapingbucket', media + "/", file_name, attributes.get("file_row_count")), terms)
+        # Rows left by other filters
+        if attributes.get("rows") is not None:
+            rows = sorted(set(rows) & set(attributes["rows"]))
+        # Rows whose url is in an earlier shard are not served
+        duplicate_rows = set(attributes.get("duplicate_rows") or ())
+        return [row for row in rows if row not in duplicate_rows]
+
+    indexed_documents = [document for document, is_indexed in documents if is_indexed]
+    indexed_rows = dict(zip([document[0] for document in indexed_documents], await parallel_async(load_rows, indexed_documents)))
+    matches = []
+    for (file_name, row_count, attributes), is_indexed in documents:
+        if not is_indexed:
+            matches.append((file_name, row_count, dict(attributes, pending=True, scan_text=True)))
+        elif len(indexed_rows[file_name]) > 0:
+            matches.append((file_name, len(indexed_rows[file_name]), dict(attributes, rows=indexed_rows[file_name])))
+    return matches
+
+# Index the text of a shard, the dictionary is saved by the caller
+def index_shard(s3_client, index: TextIndex, bucket_name: str, prefix: str, file_name: str, df):
+    postings = build_postings(df["text"] if "text" in df.columns else [])
+    save_postings(s3_client, bucket_name, prefix, file_name, postings)
+    index.add_shard(file_name, postings, len(df.index))
+    return postings
+
+async def index_media(media: str, rebuild: bool):
+    from utils import data_access, log_utils
+    bucket_name = media + 'scrapingbucket'
+    prefix = media + "/"
+    mongo_collection = data_access.MongoClient['scraping'][COLLECTION_NAME]
+    index = TextIndex() if rebuild else await run_in_thread(load_dictionary, data_access.s3_client, media, False)
+    documents = [document async for document in mongo_collection.find({"source_name": media}, {"file_name": 1, "file_format": 1, "row_count": 1})]
+
+    indexed = 0
+    for document in documents:
+        file_name = document["file_name"]
+        if index.is_indexed(file_name, document.get("row_count")):
+            continue
+        try:
+            df, _ = await run_in_thread(data_access.download_shard, bucket_name, prefix, file_name, document.get("file_format", "csv"), columns=["text"])
+            postings = await run_in_thread(index_shard, data_access.s3_client, index, bucket_name, prefix, file_name, df)
+            indexed += 1
+            print("Indexed " + file_name + ": " + str(len(postings)) + " terms")
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to index text of shard with error: " + str(e) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+    await run_in_thread(save_dictionary, data_access.s3_client, media, index)
+    print("Indexed " + str(indexed) + " shards of " + media + ", " + str(len(index.terms)) + " terms")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--media", required=True, choices=["reddit", "twitter", "test"])
+    parser.add_argument("--rebuild", action="store_true", help="index every shard again instead of only the new ones")
+    args = parser.parse_args()
+    asyncio.run(index_media(args.media, args.rebuild))
+
+if __name__ == "__main__":
+    main()
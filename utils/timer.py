@@ -3,13 +3,19 @@ import functools
 import time
 from contextlib import contextmanager
 
+from utils import metrics
+
+# Record the duration of every call in the scraping_function_duration_seconds histogram
 def timing(func):
+    histogram = metrics.FUNCTION_SECONDS.labels(func.__name__)
+
     @contextmanager
     def wrapping_logic():
-        start_ts = time.time()
-        yield
-        dur = time.time() - start_ts
-        print('{} took {:.2} seconds'.format(func.__name__, dur))
+        start_ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - start_ts)
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -21,4 +27,4 @@ def timing(func):
                 with wrapping_logic():
                     return (await func(*args, **kwargs))
             return tmp()
-    return wrapper
\ No newline at end of file
+    return wrapper
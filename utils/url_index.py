@@ -0,0 +1,143 @@
+import json
+import asyncio
+import hashlib
+import argparse
+from array import array
+
+from utils import data_access, log_utils
+from utils.multithread import run_in_thread
+
+# Per media index of the urls of all shards: a Bloom filter answering most "new url" lookups and
+# an exact set of 64-bit url hashes confirming the rest. Shards are indexed oldest first and the
+# rows whose url is already in an earlier shard with the same search keys are written to the shard
+# metadata, so that pages are computed over unique rows and get_data does not loop to replace
+# duplicates. A url is hashed with the search keys of its shard: a searchKey query only reads shards
+# of its search key, and must keep the rows first seen in the shards of another one.
+# Run from the root directory: python -m utils.url_index --media reddit
+COLLECTION_NAME = "scraping"
+INDEX_PREFIX = ".url_index/"
+BITS_PER_URL = 10
+HASH_COUNT = 7
+# Indexes of an older version are built again
+VERSION = 2
+
+# Search keys of a shard as compared by the metadata queries, which ignore case
+def search_scope(search_keys) -> str:
+    return "\x1f".join(str(search_key).lower() for search_key in search_keys or [])
+
+def url_hash(url, scope: str = "") -> int:
+    return int.from_bytes(hashlib.blake2b((scope + "\x00" + str(url)).encode("utf-8"), digest_size=8).digest(), "little")
+
+class BloomFilter:
+    def __init__(self, size: int):
+        self.size = max(size, 8 * 1024)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # Double hashing of the two halves of the 64-bit url hash
+    def positions(self, value: int):
+        first = value & 0xFFFFFFFF
+        second = (value >> 32) | 1
+        return [(first + i * second) % self.size for i in range(HASH_COUNT)]
+
+    def add(self, value: int):
+        for position in self.positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: int):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(value))
+
+class UrlIndex:
+    def __init__(self, hashes=(), file_names=()):
+        self.hashes = set(hashes)
+        self.file_names = set(file_names)
+        self.bloom = BloomFilter(max(len(self.hashes), 1024 * 1024) * BITS_PER_URL)
+        for value in self.hashes:
+            self.bloom.add(value)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, value: int) -> bool:
+        """Add a url hash, returns False when it was already indexed."""
+        if value in self.bloom and value in self.hashes:
+            return False
+        self.bloom.add(value)
+        self.hashes.add(value)
+        return True
+
+    # Row numbers of the shard whose url is in an earlier shard with the same search keys or earlier
+    # in the same shard
+    def index_shard(self, file_name: str, urls, search_keys=None):
+        scope = search_scope(search_keys)
+        duplicate_rows = [row for row, url in enumerate(urls) if not self.add(url_hash(url, scope))]
+        self.file_names.add(file_name)
+        return duplicate_rows
+
+    # Header line with the indexed file names followed by the hashes as unsigned 64-bit integers
+    def dumps(self) -> bytes:
+        header = json.dumps({"version": VERSION, "file_names": sorted(self.file_names), "count": len(self.hashes)}).encode("utf-8")
+        return header + b"\n" + array("Q", self.hashes).tobytes()
+
+    @classmethod
+    def loads(cls, data: bytes):
+        header_end = data.index(b"\n")
+        header = json.loads(data[:header_end])
+        if header.get("version") != VERSION:
+            return cls()
+        hashes = array("Q")
+        hashes.frombytes(data[header_end + 1:])
+        return cls(hashes, header["file_names"])
+
+def index_key(media: str):
+    return INDEX_PREFIX + media + ".bin"
+
+def load_index(media: str):
+    try:
+        obj = data_access.s3_client.get_object(Bucket=media + 'scrapingbucket', Key=index_key(media))
+    except Exception:
+        return UrlIndex()
+    return UrlIndex.loads(obj['Body'].read())
+
+def save_index(media: str, url_index: UrlIndex):
+    data_access.s3_client.put_object(Bucket=media + 'scrapingbucket', Key=index_key(media), Body=url_index.dumps())
+
+async def index_media(media: str, rebuild: bool):
+    mongo_collection = data_access.MongoClient['scraping'][COLLECTION_NAME]
+    url_index = UrlIndex() if rebuild else await run_in_thread(load_index, media)
+    documents = [document async for document in mongo_collection.find({"source_name": media}, {"file_name": 1, "file_format": 1, "unique_row_count": 1, "search_keys": 1}).sort("created_at", 1)]
+
+    # A shard rewritten since it was indexed lost its duplicate rows, its urls are already in the
+    # index so the whole index is built again
+    if any(document["file_name"] in url_index.file_names and document.get("unique_row_count") is None for document in documents):
+        print("Indexed shards were rewritten, rebuilding the url index of " + media)
+        url_index = UrlIndex()
+
+    indexed = 0
+    for document in documents:
+        file_name = document["file_name"]
+        if file_name in url_index.file_names:
+            continue
+        try:
+            df, _ = await run_in_thread(data_access.download_shard, media + 'scrapingbucket', media + "/", file_name, document.get("file_format", "csv"), columns=["url"])
+            duplicate_rows = url_index.index_shard(file_name, df["url"], document.get("search_keys"))
+            unique_row_count = len(df.index) - len(duplicate_rows)
+            await mongo_collection.update_one({"_id": document["_id"]}, {"$set": {"row_count": len(df.index), "unique_row_count": unique_row_count, "duplicate_rows": duplicate_rows}})
+            indexed += 1
+            print("Indexed " + file_name + ": " + str(unique_row_count) + " unique rows, " + str(len(duplicate_rows)) + " duplicates")
+        except Exception as e:
+            print(e)
+            log_utils.write_log("Failed to index urls of shard with error: " + str(e) + ". File name: " + str(file_name) + "\n", "error_log.txt")
+            # Later shards would keep urls that belong to this one
+            break
+    await run_in_thread(save_index, media, url_index)
+    print("Indexed " + str(indexed) + " shards of " + media + ", " + str(len(url_index)) + " unique urls")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--media", required=True, choices=["reddit", "twitter", "test"])
+    parser.add_argument("--rebuild", action="store_true", help="index every shard again instead of only the new ones")
+    args = parser.parse_args()
+    asyncio.run(index_media(args.media, args.rebuild))
+
+if __name__ == "__main__":
+    main()